@@ -1,40 +1,177 @@
 from flask import Flask, request, jsonify, render_template,Response
 from flask_cors import CORS, cross_origin
-from pipelines.training_pipelines import train_pipeline
-from ultralytics import YOLO
+from flask_sock import Sock
+from pipelines.training_jobs import TrainingJobRunner
+from serving.batching import InferenceBatcher
+from serving.metrics import (CACHE_HITS, CACHE_MISSES, DECODE_SECONDS, ENCODE_SECONDS, ERRORS, REQUESTS,
+                             STREAM_DROPPED, STREAM_PROCESSED, STREAM_REJECTED, error_type, model_swapped,
+                             observe_batch, observe_model_speed, render_metrics)
+from serving.model_registry import ModelRegistry, latest_trained_weights, promoted_weights
+from serving.prediction_cache import PredictionCache
+from serving.postprocess import detections, shade_flag
+from serving.sheet import score_sheet
+from serving.stream import TRY_AGAIN_LATER, StreamLimit, next_latest_frame
+from serving.workers import request_reload, server_pid
 import os
+import io
+import json
+import uuid
+import time
 import base64
+import numpy as np
 from PIL import Image
 
 current_folder = os.getcwd()
-model = YOLO(current_folder + '/shade_v6.pt')
+# The last model promoted by the pipeline's evaluate step, shade_v6.pt until there is one
+WEIGHTS_PATH = os.environ.get("OMR_WEIGHTS") or promoted_weights() or current_folder + '/shade_v6.pt'
+# pytorch, onnx or openvino, the exported models are produced by steps/model_export
+BACKEND = os.environ.get("OMR_BACKEND", "pytorch")
 
-def decodeImage(imgstring, fileName):
-    imgdata = base64.b64decode(imgstring)
-    with open("./data/" + fileName, 'wb') as f:
-        f.write(imgdata)
-        f.close()
+# Loaded and warmed up before the first request, later versions are swapped in by /model/reload
+registry = ModelRegistry(backend=BACKEND)
+registry.load(WEIGHTS_PATH, background=False)
 
+CACHE_MAX_BYTES = int(os.environ.get("OMR_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CACHE_TTL_SECONDS = float(os.environ.get("OMR_CACHE_TTL_SECONDS", 3600))
 
-def encodeImageIntoBase64(croppedImagePath):
-    with open(croppedImagePath, "rb") as f:
-        return base64.b64encode(f.read())
+# Resent images are answered from here, a model swap empties it
+prediction_cache = PredictionCache(max_bytes=CACHE_MAX_BYTES, ttl_seconds=CACHE_TTL_SECONDS)
+registry.add_listener(prediction_cache.clear)
+registry.add_listener(model_swapped)
+model_swapped(registry.active())
+
+MAX_BATCH_SIZE = int(os.environ.get("OMR_MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get("OMR_MAX_BATCH_WAIT_MS", 10))
+
+# Open /predict/stream sockets per worker, keep it well under the worker's request threads
+stream_limit = StreamLimit(int(os.environ.get("OMR_MAX_STREAMS", 8)))
+
+SHEET_TILE_SIZE = int(os.environ.get("OMR_SHEET_TILE_SIZE", 640))
+SHEET_TILE_OVERLAP = int(os.environ.get("OMR_SHEET_TILE_OVERLAP", 128))
+
+# Only the batcher thread touches the model, concurrent requests share its batched calls
+batcher = InferenceBatcher(
+    registry.predict,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_BATCH_WAIT_MS,
+    on_batch=observe_batch,
+)
+
+def decodeImage(imgstring):
+    """
+    Decode a base64 string into an in-memory PIL image
+    """
+    return openImage(base64.b64decode(imgstring))
+
+
+def openImage(imgdata):
+    """
+    Open raw image bytes as an in-memory PIL image
+    """
+    image = Image.open(io.BytesIO(imgdata))
+    return image.convert("RGB")
+
+
+def encodeImage(image_array):
+    """
+    Encode an annotated BGR array (as returned by Results.plot) into JPEG bytes
+    """
+    buffer = io.BytesIO()
+    Image.fromarray(image_array[..., ::-1]).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def encodeImageIntoBase64(image_array):
+    """
+    Encode an annotated BGR array (as returned by Results.plot) into base64 JPEG bytes
+    """
+    return base64.b64encode(encodeImage(image_array))
 
 APP_HOST = "0.0.0.0"
 APP_PORT = 8080
 
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app)
+
+training_jobs = TrainingJobRunner()
+
+def endpoint_label():
+    """
+    Route of the current request, e.g. /predict/batch, the endpoint label of both request and error counts
+    """
+    return request.url_rule.rule if request.url_rule is not None else "unknown"
+
+
+@app.after_request
+def countRequest(response):
+    REQUESTS.labels(endpoint=endpoint_label(), status=response.status_code).inc()
+    return response
 
-class ClientApp:
-    def __init__(self):
-        self.filename = "inputImage.jpg"
 
+@app.route("/metrics")
+def metricsRoute():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
-@app.route("/train")
+
+@app.route("/train", methods=['POST','GET'])
 def trainRoute():
-    train_pipeline()
-    return "Training Successfull!!" 
+    job_id = training_jobs.submit()
+    return jsonify({"job_id": job_id, "status": training_jobs.status(job_id)}), 202
+
+
+@app.route("/train/status", defaults={"job_id": None})
+@app.route("/train/status/<job_id>")
+def trainStatusRoute(job_id):
+    status = training_jobs.status(job_id)
+    if status is None:
+        return jsonify({"error": "Training job not found"}), 404
+    return jsonify(status)
+
+@app.route("/model")
+def modelRoute():
+    active = registry.active()
+    return jsonify({
+        "model_version": active.version,
+        "weights": os.path.relpath(active.weights_path, current_folder),
+        "backend": active.backend,
+        "loaded_at": active.loaded_at,
+        "loading": registry.loading,
+        "last_error": registry.last_error,
+    })
+
+
+@app.route("/model/reload", methods=['POST'])
+def modelReloadRoute():
+    """
+    Load new weights in the background, defaults to the last promoted model, or the latest
+    training run's best.pt when nothing was promoted.
+    Under gunicorn the master loads them and replaces every worker.
+    """
+    weights = (request.get_json(silent=True) or {}).get("weights")
+    if weights is None:
+        weights_path = promoted_weights() or latest_trained_weights(os.path.join(current_folder, "runs"))
+    else:
+        weights_path = os.path.abspath(os.path.join(current_folder, weights))
+        if not weights_path.startswith(current_folder + os.sep):
+            return jsonify({"error": "Weights must be inside the app folder"}), 400
+    if weights_path is None or not os.path.isfile(weights_path):
+        return jsonify({"error": "Weights not found"}), 404
+
+    try:
+        if server_pid() is not None:
+            request_reload(weights_path)
+        else:
+            registry.load(weights_path)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify({"loading": os.path.relpath(weights_path, current_folder),
+                    "model_version": registry.active().version}), 202
+
+@app.route("/cache")
+def cacheRoute():
+    return jsonify(prediction_cache.stats())
 
 @app.route("/")
 def home():
@@ -42,28 +179,14 @@ def home():
 
 
 def check_lorek(image):
+    return score_prediction(batcher.submit(image))
+
+
+def score_prediction(future):
     try:
-        flag = 0
-        highest_probability = 0.0
-        class_id = ''
-        results = model.predict(source=image, save=True)
-        result = results[0]
-        
-        if len(result) == 0:
-            return ""
-            
-        for i, box in enumerate(result.boxes):
-            class_id = result.names[box.cls[0].item()]
-            probability = box.conf.item()
-            print('class_id: ', class_id, ' probability:', probability)
-            if probability > highest_probability:
-                highest_probability = probability
-                final_class_id = class_id
-
-        print('Final class_id: ', final_class_id, ' Probability: ', highest_probability)
-        if final_class_id == 'shade':
-            flag = 1
-        return flag
+        result, model_version = future.result()
+        observe_model_speed(result)
+        return shade_flag(result), result, model_version
 
     except Exception as e:
         if "OMRB_NOT_FOUND:OMR bubble not found" in str(e) or "DPLICATE_OMR:Duplicate OMR found" in str(e):
@@ -72,34 +195,247 @@ def check_lorek(image):
             raise Exception("OMR_ERR: OMR Error")
 
 
+# json: detections only, image: base64 annotated image (the original shape),
+# both: detections and base64 image, binary: raw JPEG, multipart: JSON and JPEG parts
+RESPONSE_MODES = ("json", "image", "both", "binary", "multipart")
+
+
+def request_image_bytes():
+    """
+    Raw image bytes of the request, sent as the body or base64 encoded in the JSON 'image' key
+    """
+    if request.mimetype.startswith("image/") or request.mimetype == "application/octet-stream":
+        return request.get_data()
+    return base64.b64decode(request.json['image'])
+
+
+def prediction_payload(flag, prediction, model_version, render):
+    """
+    Response payload of a prediction, as stored in the prediction cache.
+    The annotated JPEG is only rendered when the response needs it.
+    """
+    image = None
+    if render:
+        with ENCODE_SECONDS.time():
+            image = encodeImage(prediction.plot())
+    return {
+        "flag": flag,
+        "detections": detections(prediction),
+        "image": image,
+        "model_version": model_version,
+    }
+
+
+def cache_payload(imgdata, payload):
+    size_bytes = len(payload["image"] or b"") + 128 * (len(payload["detections"]) + 1)
+    prediction_cache.put(PredictionCache.key(imgdata, payload["model_version"]), payload, size_bytes=size_bytes)
+
+
+def cached_payload(imgdata, render):
+    # An entry cached by a JSON-only request has no rendered image to offer
+    payload = prediction_cache.get(PredictionCache.key(imgdata, registry.active().version),
+                                   accept=lambda payload: not render or payload["image"] is not None)
+    (CACHE_MISSES if payload is None else CACHE_HITS).inc()
+    return payload
+
+
+def json_body(payload, mode):
+    body = {"model_version": payload["model_version"]}
+    if mode in ("json", "both"):
+        body["flag"] = payload["flag"]
+        body["detections"] = payload["detections"]
+    if mode in ("image", "both"):
+        body["image"] = base64.b64encode(payload["image"]).decode('utf-8')
+    return body
+
+
+def prediction_response(payload, mode):
+    if mode == "binary":
+        response = Response(payload["image"], mimetype="image/jpeg")
+        response.headers["X-OMR-Flag"] = str(payload["flag"])
+        response.headers["X-Model-Version"] = payload["model_version"]
+        return response
+    if mode == "multipart":
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode(),
+            json.dumps(json_body(payload, "json")).encode(),
+            f"\r\n--{boundary}\r\nContent-Type: image/jpeg\r\n"
+            f"Content-Disposition: attachment; filename=\"annotated.jpg\"\r\n\r\n".encode(),
+            payload["image"],
+            f"\r\n--{boundary}--\r\n".encode(),
+        ])
+        return Response(body, content_type=f"multipart/mixed; boundary={boundary}")
+    return jsonify(json_body(payload, mode))
+
 
 @app.route("/predict", methods=['POST','GET'])
 @cross_origin()
 def predictRoute():
+    mode = request.args.get("response", "image")
+    if mode not in RESPONSE_MODES:
+        return jsonify({"error": f"response must be one of {', '.join(RESPONSE_MODES)}"}), 400
+    render = mode != "json"
     try:
-        image = request.json['image']
-        decodeImage(image, clApp.filename)
+        started = time.perf_counter()
+        imgdata = request_image_bytes()
+        decode_seconds = time.perf_counter() - started
 
-        image_predict = Image.open(current_folder+'/data'+'/inputImage.jpg')
-        check_lorek(image_predict)
-        #os.system("cd yolov5/ && python detect.py --weights my_model.pt --img 416 --conf 0.5 --source ../data/inputImage.jpg")
+        payload = cached_payload(imgdata, render)
+        if payload is None:
+            started = time.perf_counter()
+            image_predict = openImage(imgdata)
+            DECODE_SECONDS.observe(decode_seconds + time.perf_counter() - started)
 
-        opencodedbase64 = encodeImageIntoBase64("runs/detect/predict/inputImage.jpg")
-        result = {"image": opencodedbase64.decode('utf-8')}
-        os.system("rm -rf runs/detect/predict")
+            payload = prediction_payload(*check_lorek(image_predict), render=render)
+            cache_payload(imgdata, payload)
+
+        return prediction_response(payload, mode)
 
     except ValueError as val:
         print(val)
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(val)).inc()
         return Response("Value not found inside  json data")
-    except KeyError:
+    except KeyError as e:
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
         return Response("Key value error incorrect key passed")
     except Exception as e:
         print(e)
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
         result = "Invalid input"
 
     return jsonify(result)
 
 
+@app.route("/predict/batch", methods=['POST'])
+@cross_origin()
+def predictBatchRoute():
+    mode = request.args.get("response", "image")
+    if mode not in ("json", "image", "both"):
+        return jsonify({"error": "response must be one of json, image, both"}), 400
+    render = mode != "json"
+    try:
+        images = request.json['images']
+
+        # Queue every cache miss first so they are batched together
+        pending = []
+        for image in images:
+            try:
+                started = time.perf_counter()
+                imgdata = base64.b64decode(image)
+                decode_seconds = time.perf_counter() - started
+
+                payload = cached_payload(imgdata, render)
+                future = None
+                if payload is None:
+                    started = time.perf_counter()
+                    image_predict = openImage(imgdata)
+                    DECODE_SECONDS.observe(decode_seconds + time.perf_counter() - started)
+                    future = batcher.submit(image_predict)
+                pending.append((imgdata, payload, future))
+            except Exception as e:
+                print(e)
+                ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+                pending.append((None, None, None))
+
+        predictions = []
+        for imgdata, payload, future in pending:
+            try:
+                if payload is None:
+                    if future is None:
+                        predictions.append("Invalid input")
+                        continue
+                    payload = prediction_payload(*score_prediction(future), render=render)
+                    cache_payload(imgdata, payload)
+                predictions.append(json_body(payload, mode))
+            except Exception as e:
+                print(e)
+                ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+                predictions.append("Invalid input")
+        result = {"results": predictions}
+
+    except KeyError as e:
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+        return Response("Key value error incorrect key passed")
+    except Exception as e:
+        print(e)
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+        result = "Invalid input"
+
+    return jsonify(result)
+
+
+@app.route("/predict/sheet", methods=['POST'])
+@cross_origin()
+def predictSheetRoute():
+    """
+    Score every bubble of a full answer sheet in one request
+    """
+    options_per_question = (request.get_json(silent=True) or {}).get('options_per_question')
+    if options_per_question is not None:
+        try:
+            # Through str so floats and booleans are refused rather than truncated
+            options_per_question = int(str(options_per_question))
+        except ValueError:
+            options_per_question = 0
+        if options_per_question < 1:
+            return jsonify({"error": "options_per_question must be a whole number of at least 1"}), 400
+    try:
+        image = request.json['image']
+        image_sheet = np.asarray(decodeImage(image))[..., ::-1]
+
+        result = score_sheet(image_sheet, batcher, options_per_question=options_per_question,
+                             tile_size=SHEET_TILE_SIZE, overlap=SHEET_TILE_OVERLAP)
+
+    except ValueError as val:
+        print(val)
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(val)).inc()
+        return Response("Value not found inside  json data")
+    except KeyError as e:
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+        return Response("Key value error incorrect key passed")
+    except Exception as e:
+        print(e)
+        ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+        result = "Invalid input"
+
+    return jsonify(result)
+
+
+@sock.route("/predict/stream")
+def predictStreamRoute(ws):
+    """
+    Score webcam frames pushed over a WebSocket, one JSON message back per scored frame.
+    Frames are binary JPEG messages or base64 text messages.
+    Frames that arrive while one is being scored are dropped, so each client has at most
+    one image in the shared batcher and a slow model never builds up a backlog.
+    Past OMR_MAX_STREAMS open streams in the worker, new ones are closed with code 1013.
+    """
+    if not stream_limit.try_acquire():
+        STREAM_REJECTED.inc()
+        ws.close(reason=TRY_AGAIN_LATER, message="Too many streams, try again later")
+        return
+    try:
+        frame_id = 0
+        while True:
+            frame, dropped = next_latest_frame(ws)
+            frame_id += dropped + 1
+            STREAM_PROCESSED.inc()
+            STREAM_DROPPED.inc(dropped)
+            try:
+                with DECODE_SECONDS.time():
+                    image_predict = openImage(frame if isinstance(frame, bytes) else base64.b64decode(frame))
+                payload = prediction_payload(*check_lorek(image_predict), render=False)
+                message = {"frame": frame_id, "dropped": dropped, **json_body(payload, "json")}
+            except Exception as e:
+                print(e)
+                ERRORS.labels(endpoint=endpoint_label(), error_type=error_type(e)).inc()
+                message = {"frame": frame_id, "dropped": dropped, "error": "Invalid input"}
+            ws.send(json.dumps(message))
+    finally:
+        stream_limit.release()
+
+
 if __name__ == "__main__":
-    clApp = ClientApp()
-    app.run(host=APP_HOST, port=APP_PORT, debug=True)
\ No newline at end of file
+    # Development server, production runs under gunicorn with gunicorn.conf.py
+    app.run(host=APP_HOST, port=APP_PORT, debug=os.environ.get("FLASK_DEBUG") == "1")
\ No newline at end of file
@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import platform
+import subprocess
+
+import numpy as np
+
+PACKAGE_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+DEFAULT_IMAGE_PATH = os.path.join(PACKAGE_FOLDER, "data", "inputImage.jpg")
+STUB_WEIGHTS_PATH = os.path.join(PACKAGE_FOLDER, "runs", "bench", "stub_yolov8n.pt")
+
+
+def stub_weights(weights_path: str = STUB_WEIGHTS_PATH) -> str:
+    """
+    Small randomly initialised YOLOv8n built from its YAML, no download or GPU needed
+    """
+    if not os.path.exists(weights_path):
+        from ultralytics import YOLO
+        os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+        YOLO("yolov8n.yaml").save(weights_path)
+    return weights_path
+
+
+def summarize(latencies_ms) -> dict:
+    latencies_ms = np.asarray(latencies_ms, dtype=np.float64)
+    if latencies_ms.size == 0:
+        return {"count": 0}
+    return {
+        "count": int(latencies_ms.size),
+        "mean_ms": float(latencies_ms.mean()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(latencies_ms.max()),
+    }
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=PACKAGE_FOLDER,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_results(results: dict, output_path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {output_path}")
@@ -0,0 +1,138 @@
+"""
+Drive /predict with concurrent clients and report latency percentiles and throughput.
+
+    python -m benchmarks.load_test --url http://localhost:8080/predict --concurrency 16 --rate 50
+    python -m benchmarks.load_test --in-process --concurrency 8 --requests 200
+"""
+import os
+import time
+import json
+import base64
+import argparse
+import threading
+import urllib.request
+from collections import Counter
+
+from benchmarks.common import DEFAULT_IMAGE_PATH, environment, stub_weights, summarize, write_results
+
+
+def request_body(image_bytes, index, binary, unique):
+    """
+    Body of one request. With unique, bytes after the JPEG end marker make every image
+    distinct so the prediction cache does not answer the run.
+    """
+    if unique:
+        image_bytes = image_bytes + index.to_bytes(8, "little")
+    if binary:
+        return image_bytes, {"Content-Type": "image/jpeg"}
+    body = json.dumps({"image": base64.b64encode(image_bytes).decode("utf-8")}).encode("utf-8")
+    return body, {"Content-Type": "application/json"}
+
+
+def http_sender(url):
+    def send(body, headers):
+        request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+    return send
+
+
+def in_process_sender(path):
+    # Imported late so OMR_WEIGHTS can point the app at the stub model first
+    import app
+    local = threading.local()
+
+    def send(body, headers):
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        return local.client.post(path, data=body, headers=headers).status_code
+    return send
+
+
+def run_load(send, make_body, concurrency, total_requests, rate):
+    """
+    Send total_requests with concurrency workers. With a rate (requests per second) sends follow
+    a fixed schedule and latency counts from the scheduled time, so queueing delay is included.
+    """
+    latencies = []
+    outcomes = Counter()
+    lock = threading.Lock()
+    next_index = iter(range(total_requests))
+    start = time.perf_counter()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            body, headers = make_body(index)
+            scheduled = start + index / rate if rate else time.perf_counter()
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = send(body, headers)
+            except Exception as e:
+                status = type(e).__name__
+            elapsed_ms = (time.perf_counter() - scheduled) * 1000
+            with lock:
+                outcomes[str(status)] += 1
+                if status == 200:
+                    latencies.append(elapsed_ms)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    return {
+        "wall_time_s": wall_time,
+        "throughput_rps": len(latencies) / wall_time,
+        "outcomes": dict(outcomes),
+        "latency": summarize(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080/predict")
+    parser.add_argument("--in-process", action="store_true", help="drive the Flask app in this process with a stub model")
+    parser.add_argument("--image", default=DEFAULT_IMAGE_PATH)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=0, help="target requests per second, 0 sends as fast as possible")
+    parser.add_argument("--response", default="image", help="response mode passed to /predict")
+    parser.add_argument("--binary", action="store_true", help="upload raw JPEG bytes instead of base64 JSON")
+    parser.add_argument("--repeat-image", action="store_true", help="send identical bytes, measuring prediction cache hits")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--output", default=os.path.join("runs", "bench", f"load_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as image_file:
+        image_bytes = image_file.read()
+
+    if args.in_process:
+        os.environ.setdefault("OMR_WEIGHTS", stub_weights())
+        send = in_process_sender(f"/predict?response={args.response}")
+    else:
+        send = http_sender(f"{args.url}?response={args.response}")
+
+    warmup_offset = args.requests
+    run_load(send, lambda index: request_body(image_bytes, warmup_offset + index, args.binary, not args.repeat_image),
+             min(args.concurrency, max(args.warmup, 1)), args.warmup, 0)
+    results = run_load(send, lambda index: request_body(image_bytes, index, args.binary, not args.repeat_image),
+                       args.concurrency, args.requests, args.rate)
+    results.update({"environment": environment(), "arguments": vars(args)})
+
+    latency = results["latency"]
+    print(f"{results['throughput_rps']:.1f} req/s, p50 {latency.get('p50_ms', 0):.1f} ms, "
+          f"p95 {latency.get('p95_ms', 0):.1f} ms, p99 {latency.get('p99_ms', 0):.1f} ms, outcomes {results['outcomes']}")
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Time each stage of the /predict serving path on its own, against a local stub model.
+
+    python -m benchmarks.stage_bench --iterations 50
+"""
+import os
+import time
+import base64
+import argparse
+
+from benchmarks.common import DEFAULT_IMAGE_PATH, environment, stub_weights, summarize, write_results
+
+
+def time_stage(function, iterations):
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return summarize(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default=DEFAULT_IMAGE_PATH)
+    parser.add_argument("--weights", help="weights to benchmark, defaults to a random-init YOLOv8n stub")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", default=os.path.join("runs", "bench", f"stages_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    args = parser.parse_args()
+
+    # The stages are the app's own helpers, imported once the app is pointed at the stub model
+    os.environ["OMR_WEIGHTS"] = args.weights or stub_weights()
+    import app
+    from serving.postprocess import detections, shade_flag
+
+    with open(args.image, "rb") as image_file:
+        image_bytes = image_file.read()
+    encoded = base64.b64encode(image_bytes)
+    image = app.openImage(image_bytes)
+    model = app.registry.active().model
+    result = model.predict(source=image, save=False, verbose=False)[0]
+    annotated = result.plot()
+
+    stages = {
+        "base64_decode": lambda: base64.b64decode(encoded),
+        "pil_open": lambda: app.openImage(image_bytes),
+        "model_predict": lambda: model.predict(source=image, save=False, verbose=False),
+        "postprocess": lambda: (shade_flag(result), detections(result)),
+        "render": lambda: result.plot(),
+        "encode_jpeg": lambda: app.encodeImage(annotated),
+        "encode_base64": lambda: app.encodeImageIntoBase64(annotated),
+    }
+
+    results = {"stages": {}, "predictor_breakdown_ms": {}, "environment": environment(), "arguments": vars(args)}
+    for name, function in stages.items():
+        for _ in range(args.warmup):
+            function()
+        results["stages"][name] = time_stage(function, args.iterations)
+        print(f"{name:>15}: p50 {results['stages'][name]['p50_ms']:8.2f} ms, p95 {results['stages'][name]['p95_ms']:8.2f} ms")
+
+    # ultralytics times its own preprocess, inference and postprocess for every predict call
+    speeds = [model.predict(source=image, save=False, verbose=False)[0].speed for _ in range(args.iterations)]
+    for key in speeds[0]:
+        results["predictor_breakdown_ms"][key] = summarize([speed[key] for speed in speeds])
+
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Compare training epoch wall time and peak RAM with and without the pre-decoded image cache.
+Each mode trains in its own process so the peak RAM figures don't mix. Needs the dataset
+prepared by the pipeline (datasets/data.yaml and the split manifest).
+
+    python -m benchmarks.train_bench
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from benchmarks.common import PACKAGE_FOLDER, environment, write_results
+
+TRAIN_COMMAND = "from steps.model_train import model_train; model_train(image_cache={image_cache})"
+
+
+def train_once(image_cache: bool) -> dict:
+    subprocess.run([sys.executable, "-c", TRAIN_COMMAND.format(image_cache=image_cache)],
+                   check=True, env={**os.environ, "PYTHONPATH": PACKAGE_FOLDER})
+    from steps.model_train import PROFILE_FILE_NAME, artifact_path
+    with open(os.path.join(os.getcwd(), artifact_path, PROFILE_FILE_NAME), 'r') as profile_file:
+        return json.load(profile_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=os.path.join("runs", "bench", f"train_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    args = parser.parse_args()
+
+    from steps.image_cache import cache_folder_for, image_cache, image_size
+    if not os.path.exists(cache_folder_for(image_size)):
+        image_cache()
+
+    results = {"environment": environment()}
+    for mode, use_cache in (("jpeg", False), ("image_cache", True)):
+        results[mode] = train_once(use_cache)
+        print(f"{mode}: {results[mode]['epoch_seconds']} s per epoch, peak RAM {results[mode]['peak_rss_mb']:.0f} MB")
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
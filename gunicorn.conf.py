@@ -0,0 +1,71 @@
+"""
+Production serving: gunicorn loads app.py, and with it the model, once in the master process and
+forks the workers from it, so every worker shares the weights pages copy-on-write.
+
+    gunicorn app:app
+
+kill -HUP <master pid> replaces the workers gracefully, POST /model/reload loads new weights in the
+master first so the replacements are forked with them.
+"""
+import os
+import gc
+import shutil
+import logging
+
+from serving.workers import SERVER_PID_ENV, available_cores, take_reload_request
+
+cores = available_cores()
+# Intra-op threads per worker, workers x threads stays within the cores so they don't oversubscribe
+torch_threads = int(os.environ.get("OMR_TORCH_THREADS", min(2, cores)))
+
+bind = f"{os.environ.get('OMR_HOST', '0.0.0.0')}:{os.environ.get('OMR_PORT', 8080)}"
+workers = int(os.environ.get("OMR_WORKERS", max(1, cores // torch_threads)))
+# Request threads per worker, they feed the worker's batcher so concurrent requests share model calls.
+# Every open /predict/stream WebSocket holds one thread for as long as it is connected, app.py caps
+# them at OMR_MAX_STREAMS per worker so the rest stay free for HTTP requests.
+worker_class = "gthread"
+threads = int(os.environ.get("OMR_WORKER_THREADS", 32))
+preload_app = True
+timeout = 120
+graceful_timeout = 60
+
+# Metrics from every worker are aggregated through files, the folder must be set before
+# prometheus_client is imported. A HUP re-reads this file, the folder is only reset on first start.
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(os.getcwd(), "runs", "serving", "prometheus")
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def _app_module():
+    import app
+    return app
+
+
+def on_reload(server):
+    # Runs in the master before the new workers are forked
+    weights_path = take_reload_request()
+    if weights_path is not None:
+        registry = _app_module().registry
+        registry.load(weights_path, background=False)
+        if registry.last_error:
+            logging.error(f"Reload of {weights_path} failed, keeping {registry.active().version}")
+
+
+def pre_fork(server, worker):
+    # Objects that exist now are never collected, so the workers' garbage collector does not
+    # write to (and un-share) the pages they live in
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Pinned per worker rather than through OMP_NUM_THREADS, which training jobs started by
+    # the workers would inherit
+    import torch
+    torch.set_num_threads(torch_threads)
+    os.environ[SERVER_PID_ENV] = str(server.pid)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import logging
+import configparser
+from dataclasses import dataclass
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+STATE_FOLDER = os.path.join(os.getcwd(), "runs", "pipeline")
+STATE_FILE_NAME = "state.json"
+HASH_CACHE_FILE_NAME = "file_hashes.json"
+HASH_WORKERS = 8
+
+
+@dataclass(frozen=True)
+class Step:
+    """
+    A pipeline step and what it depends on.
+    inputs and outputs are paths relative to the working folder, files or folders.
+    config lists the config.ini sections the step reads, or single options as "section.option".
+    code lists the modules the step's function relies on besides its own, their source is
+    part of the fingerprint too.
+    Steps whose real input is remote are marked always_run, they have to look to know.
+    """
+    name: str
+    function: Callable
+    inputs: tuple = ()
+    outputs: tuple = ()
+    config: tuple = ()
+    code: tuple = ()
+    always_run: bool = False
+
+
+@dataclass
+class StepRecord:
+    name: str
+    status: str
+    fingerprint: str = None
+    started_at: float = None
+    duration_seconds: float = 0.0
+    error: str = None
+
+
+def _sha256_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class FileHasher:
+    """
+    Content hashes of files, remembered by (size, mtime) so unchanged files are never read twice
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._hashes = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as cache_file:
+                self._hashes = json.load(cache_file)
+
+    def hash_files(self, file_paths) -> dict:
+        stats = {file_path: os.stat(file_path) for file_path in file_paths}
+        stale = [file_path for file_path, stat in stats.items()
+                 if self._hashes.get(file_path, [None, None])[:2] != [stat.st_size, stat.st_mtime_ns]]
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            for file_path, digest in zip(stale, executor.map(_sha256_file, stale)):
+                self._hashes[file_path] = [stats[file_path].st_size, stats[file_path].st_mtime_ns, digest]
+        return {file_path: self._hashes[file_path][2] for file_path in file_paths}
+
+    def save(self):
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, 'w') as cache_file:
+            json.dump(self._hashes, cache_file)
+        os.replace(temp_path, self.cache_path)
+
+
+def _files_under(path):
+    if os.path.isfile(path):
+        return [path]
+    file_paths = []
+    for folder, folder_names, file_names in os.walk(path):
+        folder_names.sort()
+        file_paths.extend(os.path.join(folder, file_name) for file_name in sorted(file_names))
+    return file_paths
+
+
+class StepRunner:
+    """
+    Run steps in order, skipping a step when its fingerprint (code, config sections and input
+    contents) matches its last successful run and its outputs are still there
+    """
+    def __init__(self, steps, config_path: str, working_folder: str = None, state_folder: str = STATE_FOLDER):
+        self.steps = steps
+        self.config_path = config_path
+        self.working_folder = working_folder or os.getcwd()
+        self.state_folder = state_folder
+        os.makedirs(state_folder, exist_ok=True)
+        self.state_path = os.path.join(state_folder, STATE_FILE_NAME)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as state_file:
+                self.state = json.load(state_file)
+        self.hasher = FileHasher(os.path.join(state_folder, HASH_CACHE_FILE_NAME))
+
+    def fingerprint(self, step: Step) -> str:
+        sha256 = hashlib.sha256()
+        sha256.update(step.name.encode())
+        sha256.update(_sha256_file(inspect.getsourcefile(step.function)).encode())
+        for module in step.code:
+            sha256.update(f"{module.__name__}:{_sha256_file(inspect.getsourcefile(module))}".encode())
+
+        confp = configparser.RawConfigParser()
+        confp.read(self.config_path)
+        for entry in step.config:
+            section, _, option = entry.partition(".")
+            items = sorted(confp.items(section)) if confp.has_section(section) else []
+            if option:
+                items = [item for item in items if item[0] == option]
+            sha256.update(json.dumps([entry, items]).encode())
+
+        for input_path in step.inputs:
+            absolute_path = os.path.join(self.working_folder, input_path)
+            if not os.path.exists(absolute_path):
+                sha256.update(f"{input_path}:missing".encode())
+                continue
+            for file_path, digest in self.hasher.hash_files(_files_under(absolute_path)).items():
+                sha256.update(f"{os.path.relpath(file_path, self.working_folder)}:{digest}".encode())
+        return sha256.hexdigest()
+
+    def failed_step(self) -> str:
+        """
+        Name of the step the last run failed on, None when it succeeded
+        """
+        return self.state.get("failed_step")
+
+    def run(self, start_at: str = None, force: bool = False, progress_callback=None) -> list:
+        """
+        Run the pipeline, returns a StepRecord per step.
+        Steps before start_at are not run at all, force runs every step regardless of the cache.
+        """
+        names = [step.name for step in self.steps]
+        if start_at is not None and start_at not in names:
+            raise ValueError(f"Unknown step {start_at}, expected one of {', '.join(names)}")
+        first = names.index(start_at) if start_at is not None else 0
+
+        records = []
+        for position, step in enumerate(self.steps):
+            if position < first:
+                records.append(StepRecord(step.name, "not_run"))
+                continue
+            if progress_callback is not None:
+                progress_callback(step.name)
+            records.append(self._run_step(step, force))
+            logging.info(f"Step {step.name}: {records[-1].status} in {records[-1].duration_seconds:.2f}s")
+        return records
+
+    def _run_step(self, step: Step, force: bool) -> StepRecord:
+        started_at = time.time()
+        started = time.perf_counter()
+        fingerprint = self.fingerprint(step)
+        previous = self.state.get("steps", {}).get(step.name, {})
+        outputs_present = all(os.path.exists(os.path.join(self.working_folder, output)) for output in step.outputs)
+
+        if (not force and not step.always_run and outputs_present and previous.get("status") == "succeeded"
+                and previous.get("fingerprint") == fingerprint):
+            record = StepRecord(step.name, "cached", fingerprint, started_at, time.perf_counter() - started)
+            self._save(record)
+            return record
+
+        try:
+            step.function()
+        except Exception as e:
+            record = StepRecord(step.name, "failed", fingerprint, started_at, time.perf_counter() - started, str(e))
+            self._save(record)
+            raise
+        # Taken after the run, so a step that rewrites one of its own inputs does not look changed next time
+        record = StepRecord(step.name, "succeeded", self.fingerprint(step), started_at, time.perf_counter() - started)
+        self._save(record)
+        return record
+
+    def _save(self, record: StepRecord):
+        steps = self.state.setdefault("steps", {})
+        steps[record.name] = {
+            "status": record.status if record.status != "cached" else "succeeded",
+            "fingerprint": record.fingerprint,
+            "started_at": record.started_at,
+            "duration_seconds": record.duration_seconds,
+            "cached": record.status == "cached",
+            "error": record.error,
+        }
+        if record.status == "failed":
+            self.state["failed_step"] = record.name
+        elif self.state.get("failed_step") == record.name:
+            self.state["failed_step"] = None
+
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.replace(temp_path, self.state_path)
+        self.hasher.save()
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import logging
+import subprocess
+from pathlib import Path
+
+from serving.workers import SERVER_PID_ENV
+
+JOBS_FOLDER = os.path.join(os.getcwd(), "runs", "jobs")
+LOCK_FILE_NAME = "train.lock"
+RUN_PIPELINE_PATH = os.path.join(Path(__file__).absolute().parent.parent, "run_pipeline.py")
+# Set for the serving process only, a training job must not write worker metrics or signal the master
+SERVING_ENV_VARS = ("PROMETHEUS_MULTIPROC_DIR", SERVER_PID_ENV)
+
+
+def _status_path(jobs_folder: str, job_id: str) -> str:
+    return os.path.join(jobs_folder, f"{job_id}.json")
+
+
+def read_status(jobs_folder: str, job_id: str) -> dict:
+    with open(_status_path(jobs_folder, job_id), 'r') as status_file:
+        return json.load(status_file)
+
+
+def update_status(jobs_folder: str, job_id: str, **fields) -> dict:
+    """
+    Merge fields into the job status file, written atomically so readers never see a partial file
+    """
+    status_path = _status_path(jobs_folder, job_id)
+    status = {}
+    if os.path.exists(status_path):
+        status = read_status(jobs_folder, job_id)
+    status.update(fields)
+    status["job_id"] = job_id
+    status["updated_at"] = time.time()
+
+    temp_path = status_path + ".tmp"
+    with open(temp_path, 'w') as status_file:
+        json.dump(status, status_file)
+    os.replace(temp_path, status_path)
+    return status
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # Exited but not collected yet, only the worker that started it can collect it
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as stat_file:
+            return stat_file.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+class TrainingJobRunner:
+    """
+    Run train_pipeline in a separate worker process, one job at a time
+    """
+    def __init__(self, jobs_folder: str = JOBS_FOLDER):
+        self.jobs_folder = jobs_folder
+        self._processes = {}
+        os.makedirs(self.jobs_folder, exist_ok=True)
+
+    def submit(self) -> str:
+        """
+        Queue a new training job and return its id immediately
+        """
+        self._reap()
+        job_id = uuid.uuid4().hex
+        update_status(self.jobs_folder, job_id, state="queued", step=None, created_at=time.time())
+
+        log_file = open(os.path.join(self.jobs_folder, f"{job_id}.log"), 'w')
+        process = subprocess.Popen(
+            [sys.executable, RUN_PIPELINE_PATH, "--job-id", job_id, "--jobs-folder", self.jobs_folder],
+            cwd=os.getcwd(),
+            env={name: value for name, value in os.environ.items() if name not in SERVING_ENV_VARS},
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        log_file.close()
+        # Keep the serving process responsive while the job trains. Set from here rather than with
+        # preexec_fn, which is unsafe in a process running other threads.
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, 10)
+        except OSError:
+            logging.warning(f"Could not lower the priority of training job {job_id}")
+        self._processes[job_id] = process
+        # Other server workers find the process through the status file
+        update_status(self.jobs_folder, job_id, pid=process.pid)
+        logging.info(f"Training job {job_id} queued (pid {process.pid})")
+        return job_id
+
+    def status(self, job_id: str = None) -> dict:
+        """
+        Return the status of the given job, or of the most recent one
+        """
+        self._reap()
+        if job_id is None:
+            job_id = self.latest_job_id()
+            if job_id is None:
+                return None
+        if not job_id.isalnum() or not os.path.exists(_status_path(self.jobs_folder, job_id)):
+            return None
+        status = read_status(self.jobs_folder, job_id)
+        if (status["state"] in ("queued", "running") and status.get("pid") is not None
+                and job_id not in self._processes and not _process_alive(status["pid"])):
+            # Started by another server worker, which only notices when it is asked itself
+            status = update_status(self.jobs_folder, job_id, state="failed", error="Worker process is gone",
+                                   finished_at=time.time())
+        return status
+
+    def latest_job_id(self) -> str:
+        status_files = [f for f in os.listdir(self.jobs_folder) if f.endswith(".json")]
+        if not status_files:
+            return None
+        latest = max(status_files, key=lambda f: os.path.getmtime(os.path.join(self.jobs_folder, f)))
+        return latest[:-len(".json")]
+
+    def _reap(self):
+        # Collect finished workers, and flag the ones that died without reporting
+        for job_id, process in list(self._processes.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            del self._processes[job_id]
+            status = read_status(self.jobs_folder, job_id)
+            if status["state"] in ("queued", "running"):
+                update_status(self.jobs_folder, job_id, state="failed",
+                              error=f"Worker exited with code {returncode}", finished_at=time.time())
+
+
+def run_job(job_id: str, jobs_folder: str = JOBS_FOLDER, resume: bool = False):
+    """
+    Worker side of a training job, waits for the training lock then runs the pipeline.
+    Unchanged steps are skipped, resume restarts from the step the last run failed on.
+    """
+    # Imported here so the serving process never loads the training dependencies
+    from pipelines.training_pipelines import PIPELINE_STEPS, train_pipeline
+
+    with open(os.path.join(jobs_folder, LOCK_FILE_NAME), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        update_status(jobs_folder, job_id, state="running", steps=[step.name for step in PIPELINE_STEPS],
+                      started_at=time.time(), pid=os.getpid())
+        try:
+            records = train_pipeline(progress_callback=lambda step: update_status(jobs_folder, job_id, step=step),
+                                     resume=resume)
+        except Exception as e:
+            update_status(jobs_folder, job_id, state="failed", error=str(e), finished_at=time.time())
+            raise
+        update_status(jobs_folder, job_id, state="succeeded", finished_at=time.time(),
+                      step_timings={record.name: {"status": record.status, "seconds": record.duration_seconds}
+                                    for record in records})
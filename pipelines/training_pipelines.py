@@ -1,10 +1,92 @@
+import os
+from pathlib import Path
+
+import serving.model_registry
+import serving.postprocess
+import steps.data_archive
+import steps.data_split
+import steps.image_cache
+import steps.model_export
+from pipelines.step_runner import Step, StepRunner
 from steps.data_ingestion import ingest_df
-from steps.data_split import split_df
+from steps.data_split import split_df, SPLIT_MANIFEST_FILE_NAME
+from steps.data_analysis import data_analysis
+from steps.image_cache import image_cache, image_size, CACHE_FOLDER, INDEX_FILE_NAME
 from steps.model_train import model_train
+from steps.model_export import model_export, artifact_path
+from steps.model_evaluate import model_evaluate, REPORT_FILE_NAME
 from steps.model_track import model_track
+from steps.model_sweep import model_sweep
+
+CONFIG_PATH = os.path.join(Path(__file__).absolute().parent.parent, "steps", "config.ini")
+
+SPLIT_MANIFEST = os.path.join("datasets", SPLIT_MANIFEST_FILE_NAME)
+ANALYSIS_PLOTS = tuple(f"data_{split}_analysis.png" for split in ("train", "test", "valid"))
+IMAGE_CACHE_INDEX = os.path.join(CACHE_FOLDER, str(image_size), INDEX_FILE_NAME)
+BEST_WEIGHTS = os.path.join(artifact_path, "weights", "best.pt")
+EXPORT_REPORT = os.path.join(artifact_path, "export_report.json")
+EVALUATION_REPORT = os.path.join(artifact_path, REPORT_FILE_NAME)
+
+PIPELINE_STEPS = [
+    # S3 can't be fingerprinted locally, the sync itself only downloads what changed
+    Step("ingest", ingest_df,
+         outputs=("datasets_temp",),
+         config=("aws", "s3", "local"),
+         code=(steps.data_archive,),
+         always_run=True),
+    Step("split", split_df,
+         inputs=("datasets_temp",),
+         outputs=(os.path.join("datasets", "data.yaml"), SPLIT_MANIFEST),
+         config=("split",)),
+    Step("analysis", data_analysis,
+         inputs=(os.path.join("datasets_temp", "labels"), SPLIT_MANIFEST, os.path.join("datasets", "data.yaml")),
+         outputs=ANALYSIS_PLOTS,
+         code=(steps.data_split,)),
+    Step("image_cache", image_cache,
+         inputs=(os.path.join("datasets_temp", "images"), SPLIT_MANIFEST),
+         outputs=(IMAGE_CACHE_INDEX,),
+         config=("train.image_size",),
+         code=(steps.data_split,)),
+    Step("train", model_train,
+         inputs=("datasets_temp", SPLIT_MANIFEST, os.path.join("datasets", "data.yaml"), IMAGE_CACHE_INDEX),
+         outputs=(BEST_WEIGHTS,),
+         config=("train", "mlflow"),
+         code=(steps.data_split, steps.image_cache)),
+    Step("export", model_export,
+         inputs=(BEST_WEIGHTS, SPLIT_MANIFEST),
+         outputs=(EXPORT_REPORT,),
+         config=("export", "train", "mlflow"),
+         code=(steps.data_split, serving.postprocess)),
+    # Also compares with the served model and promotes the new one when it is better
+    Step("evaluate", model_evaluate,
+         inputs=(BEST_WEIGHTS, EXPORT_REPORT, SPLIT_MANIFEST, os.path.join("datasets_temp", "labels"),
+                 os.path.join("datasets", "data.yaml")),
+         outputs=(EVALUATION_REPORT,),
+         config=("evaluate", "mlflow"),
+         code=(steps.data_split, steps.model_export, serving.model_registry)),
+    Step("track", model_track,
+         inputs=(os.path.join(artifact_path, "results.csv"), os.path.join(artifact_path, "weights"),
+                 EVALUATION_REPORT) + ANALYSIS_PLOTS,
+         config=("train", "mlflow")),
+]
+
+
+def train_pipeline(progress_callback=None, resume=False, start_at=None, force=False):
+    """
+    Run the pipeline, skipping steps whose code, config and inputs are unchanged since they last succeeded.
+    resume starts from the step the previous run failed on, start_at from a named step.
+    Returns the StepRecord of every step.
+    """
+    runner = StepRunner(PIPELINE_STEPS, CONFIG_PATH)
+    if resume and start_at is None:
+        start_at = runner.failed_step()
+    return runner.run(start_at=start_at, force=force, progress_callback=progress_callback)
+
 
-def train_pipeline():
-    ingest_df()
-    split_df()
-    model_train()
-    model_track()
\ No newline at end of file
+def sweep_pipeline(space_path, progress_callback=None):
+    """
+    Prepare the data like train_pipeline, then run a hyperparameter sweep instead of training one model
+    """
+    data_steps = PIPELINE_STEPS[:[step.name for step in PIPELINE_STEPS].index("train")]
+    StepRunner(data_steps, CONFIG_PATH).run(progress_callback=progress_callback)
+    return model_sweep(space_path)
@@ -1,4 +1,22 @@
-from pipelines.training_pipelines import train_pipeline
+import argparse
+from pipelines.training_pipelines import PIPELINE_STEPS, sweep_pipeline, train_pipeline
 
 if __name__ == "__main__":
-    train_pipeline()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--job-id", help="run as a queued training job and report progress")
+    parser.add_argument("--jobs-folder", help="folder holding the job status files")
+    parser.add_argument("--resume", action="store_true", help="start from the step the last run failed on")
+    parser.add_argument("--from", dest="start_at", choices=[step.name for step in PIPELINE_STEPS],
+                        help="start from this step, earlier steps are not run")
+    parser.add_argument("--force", action="store_true", help="run every step, ignoring cached results")
+    parser.add_argument("--sweep", metavar="SPACE", help="run a hyperparameter sweep over this search space file")
+    args = parser.parse_args()
+
+    if args.job_id:
+        from pipelines.training_jobs import JOBS_FOLDER, run_job
+        run_job(args.job_id, args.jobs_folder or JOBS_FOLDER, resume=args.resume)
+    elif args.sweep:
+        sweep_pipeline(args.sweep)
+    else:
+        for record in train_pipeline(resume=args.resume, start_at=args.start_at, force=args.force):
+            print(f"{record.name:<10} {record.status:<10} {record.duration_seconds:8.2f}s")
@@ -0,0 +1,96 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+
+class InferenceBatcher:
+    """
+    Combine concurrent predict calls into batched model calls
+    """
+    def __init__(self, predict_fn, max_batch_size: int = 8, max_wait_ms: float = 10.0, on_batch=None):
+        """
+        predict_fn takes a list of images and returns one result per image, in order.
+        A batch is dispatched once max_batch_size images are queued or max_wait_ms
+        has passed since the first image of the batch arrived.
+        on_batch, when given, is called with the queue wait in seconds of each image of a batch.
+        """
+        self.predict_fn = predict_fn
+        self.on_batch = on_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pid = None
+
+    def submit(self, image) -> Future:
+        """
+        Queue a single image and return a future resolving to its result
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((image, future, time.monotonic()))
+        return future
+
+    def submit_many(self, images) -> list:
+        """
+        Queue several images at once, they are batched together with other callers
+        """
+        return [self.submit(image) for image in images]
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so every process starts its own worker lazily
+        if self._pid == os.getpid() and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+            if self._pid != os.getpid() or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+                self._worker.start()
+                self._pid = os.getpid()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [(image, future, enqueued_at) for image, future, enqueued_at in self._next_batch()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            if self.on_batch is not None:
+                started_at = time.monotonic()
+                self.on_batch([started_at - enqueued_at for _, _, enqueued_at in batch])
+
+            try:
+                results = self.predict_fn([image for image, _, _ in batch])
+            except Exception as e:
+                logging.exception("Batched prediction failed")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            results = list(results)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+            # A short result list would otherwise leave callers waiting on their futures forever
+            if len(results) < len(batch):
+                error = RuntimeError(f"predict_fn returned {len(results)} results for {len(batch)} images")
+                logging.error(str(error))
+                for _, future, _ in batch[len(results):]:
+                    future.set_exception(error)
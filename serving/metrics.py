@@ -0,0 +1,83 @@
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Sub-millisecond to multi-second, the stages range from base64 decode to a full batch
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+KNOWN_ERRORS = ("OMR_ERR", "OMRB_NOT_FOUND", "DPLICATE_OMR")
+
+STAGE_SECONDS = Histogram("omr_stage_seconds", "Time spent per serving stage", ["stage"], buckets=STAGE_BUCKETS)
+REQUESTS = Counter("omr_requests_total", "HTTP requests served", ["endpoint", "status"])
+ERRORS = Counter("omr_errors_total", "Prediction errors by type", ["endpoint", "error_type"])
+BATCH_SIZE = Histogram("omr_batch_size", "Images per batched model call", buckets=BATCH_BUCKETS)
+CACHE_LOOKUPS = Counter("omr_cache_lookups_total", "Prediction cache lookups", ["result"])
+STREAM_FRAMES = Counter("omr_stream_frames_total", "Webcam stream frames received", ["result"])
+STREAM_REJECTED = Counter("omr_stream_rejected_total", "Webcam streams refused because the worker was full")
+MODEL_INFO = Gauge("omr_model_info", "Model version being served", ["version", "backend"],
+                   multiprocess_mode="livemax")
+
+# Bound once so the hot path skips the label lookup
+DECODE_SECONDS = STAGE_SECONDS.labels(stage="decode")
+QUEUE_SECONDS = STAGE_SECONDS.labels(stage="queue")
+PREPROCESS_SECONDS = STAGE_SECONDS.labels(stage="preprocess")
+INFERENCE_SECONDS = STAGE_SECONDS.labels(stage="inference")
+POSTPROCESS_SECONDS = STAGE_SECONDS.labels(stage="postprocess")
+ENCODE_SECONDS = STAGE_SECONDS.labels(stage="encode")
+CACHE_HITS = CACHE_LOOKUPS.labels(result="hit")
+CACHE_MISSES = CACHE_LOOKUPS.labels(result="miss")
+STREAM_PROCESSED = STREAM_FRAMES.labels(result="processed")
+STREAM_DROPPED = STREAM_FRAMES.labels(result="dropped")
+
+
+def error_type(e: Exception) -> str:
+    """
+    The OMR error code prefixing the message, or the exception class for anything else
+    """
+    code = str(e).split(":", 1)[0]
+    return code if code in KNOWN_ERRORS else type(e).__name__
+
+
+def observe_model_speed(result):
+    """
+    Record the per-image preprocess, inference and postprocess times ultralytics measured
+    """
+    speed = result.speed
+    PREPROCESS_SECONDS.observe((speed.get("preprocess") or 0) / 1000)
+    INFERENCE_SECONDS.observe((speed.get("inference") or 0) / 1000)
+    POSTPROCESS_SECONDS.observe((speed.get("postprocess") or 0) / 1000)
+
+
+def observe_batch(queue_waits):
+    """
+    Batcher hook, called with the queue wait of every image in a batch about to run
+    """
+    BATCH_SIZE.observe(len(queue_waits))
+    for wait in queue_waits:
+        QUEUE_SECONDS.observe(wait)
+
+
+_served_model = None
+
+
+def model_swapped(active):
+    """
+    Registry listener, flips omr_model_info to the model now being served
+    """
+    global _served_model
+    if _served_model is not None:
+        MODEL_INFO.labels(version=_served_model.version, backend=_served_model.backend).set(0)
+    MODEL_INFO.labels(version=active.version, backend=active.backend).set(1)
+    _served_model = active
+
+
+def render_metrics():
+    """
+    Prometheus text exposition, aggregated across workers when PROMETHEUS_MULTIPROC_DIR is set
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,186 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+from ultralytics import YOLO
+
+
+@dataclass(frozen=True)
+class ActiveModel:
+    model: Any
+    version: str
+    weights_path: str
+    backend: str
+    loaded_at: float
+
+
+BACKENDS = ("pytorch", "onnx", "openvino")
+PROMOTED_FOLDER = os.path.join(os.getcwd(), "runs", "serving", "promoted")
+PROMOTION_RECORD_PATH = os.path.join(os.getcwd(), "runs", "serving", "promoted.json")
+
+
+def backend_weights_path(weights_path: str, backend: str) -> str:
+    """
+    Path of the weights exported for a backend, where steps/model_export writes them
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+    stem = os.path.splitext(weights_path)[0]
+    if backend == "onnx":
+        return stem + ".onnx"
+    if backend == "openvino":
+        return stem + "_openvino_model"
+    return weights_path
+
+
+def weights_version(weights_path: str) -> str:
+    """
+    Version label of a weights file or exported model folder, its name plus a short content hash
+    """
+    if os.path.isdir(weights_path):
+        file_paths = sorted(glob.glob(os.path.join(weights_path, "**", "*"), recursive=True))
+    else:
+        file_paths = [weights_path]
+    sha256 = hashlib.sha256()
+    for file_path in filter(os.path.isfile, file_paths):
+        with open(file_path, "rb") as weights_file:
+            for chunk in iter(lambda: weights_file.read(1 << 20), b""):
+                sha256.update(chunk)
+    return f"{os.path.splitext(os.path.basename(weights_path))[0]}@{sha256.hexdigest()[:12]}"
+
+
+def latest_trained_weights(runs_folder: str) -> str:
+    """
+    Most recent best.pt written by a training run, the pipeline's or a plain ultralytics one, None when there is none
+    """
+    candidates = (glob.glob(os.path.join(runs_folder, "pipeline", "train", "weights", "best.pt"))
+                  + glob.glob(os.path.join(runs_folder, "detect", "train*", "weights", "best.pt")))
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def promoted_weights(record_path: str = PROMOTION_RECORD_PATH) -> str:
+    """
+    Weights the last promotion put into serving, None when nothing was promoted yet
+    """
+    if not os.path.exists(record_path):
+        return None
+    with open(record_path, 'r') as record_file:
+        weights_path = json.load(record_file)["weights"]
+    return weights_path if os.path.isfile(weights_path) else None
+
+
+def promote_weights(weights_path: str, report: dict, promoted_folder: str = PROMOTED_FOLDER,
+                    record_path: str = PROMOTION_RECORD_PATH) -> str:
+    """
+    Copy the weights and their exports under a versioned name, then point the promotion record at them.
+    The training folder is overwritten by the next run, the copy is not.
+    """
+    version = weights_version(weights_path)
+    os.makedirs(promoted_folder, exist_ok=True)
+    promoted_path = os.path.join(promoted_folder, version.replace("@", "_") + ".pt")
+    for backend in BACKENDS:
+        source_path = backend_weights_path(weights_path, backend)
+        dest_path = backend_weights_path(promoted_path, backend)
+        if os.path.isdir(source_path):
+            shutil.copytree(source_path, dest_path, dirs_exist_ok=True)
+        elif os.path.isfile(source_path):
+            shutil.copy(source_path, dest_path)
+
+    record = {"weights": promoted_path, "version": version, "promoted_at": time.time(), "report": report}
+    with open(record_path + ".tmp", 'w') as record_file:
+        json.dump(record, record_file, indent=2)
+    os.replace(record_path + ".tmp", record_path)
+    return promoted_path
+
+
+class ModelRegistry:
+    """
+    Hold the model used for serving and hot-swap new weights without dropping requests
+    """
+    def __init__(self, backend: str = "pytorch", warmup_runs: int = 2, warmup_size: int = 640):
+        self.backend = backend
+        self.warmup_runs = warmup_runs
+        self.warmup_size = warmup_size
+        self.last_error = None
+        self._active = None
+        self._loader = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def active(self) -> ActiveModel:
+        return self._active
+
+    def add_listener(self, listener):
+        """
+        Call listener(active_model) after every swap
+        """
+        self._listeners.append(listener)
+
+    @property
+    def loading(self) -> bool:
+        return self._loader is not None and self._loader.is_alive()
+
+    def predict(self, images) -> list:
+        """
+        Run a batch on the active model, returns (result, model version) per image.
+        The model is looked up once per batch, so a swap only affects later batches.
+        """
+        active = self._active
+        results = active.model.predict(source=images, save=False, verbose=False)
+        return [(result, active.version) for result in results]
+
+    def load(self, weights_path: str, background: bool = True):
+        """
+        Load and warm up weights, then make them the active model.
+        In the background the current model keeps serving until the swap.
+        """
+        with self._lock:
+            if self.loading:
+                raise RuntimeError("A model is already being loaded")
+            if not background:
+                self._load(weights_path)
+                return
+            self._loader = threading.Thread(target=self._load, args=(weights_path,), name="model-loader", daemon=True)
+            self._loader.start()
+
+    def _load(self, weights_path: str):
+        try:
+            backend = self.backend
+            model_path = backend_weights_path(weights_path, backend)
+            if not os.path.exists(model_path):
+                logging.warning(f"No {backend} export at {model_path}, serving the PyTorch weights")
+                backend, model_path = "pytorch", weights_path
+            version = weights_version(model_path)
+            logging.info(f"Loading {backend} model {version} from {model_path}")
+            model = YOLO(model_path, task="detect")
+            self._warm_up(model)
+        except Exception as e:
+            logging.exception(f"Failed to load model from {weights_path}")
+            self.last_error = str(e)
+            if self._active is None:
+                raise
+            return
+
+        # A single reference assignment, in-flight batches keep the model they started with
+        self._active = ActiveModel(model=model, version=version, weights_path=model_path, backend=backend,
+                                   loaded_at=time.time())
+        self.last_error = None
+        logging.info(f"Serving model {version}")
+        for listener in self._listeners:
+            listener(self._active)
+
+    def _warm_up(self, model):
+        # Pays the lazy predictor setup and first-call allocations before any request does
+        blank = np.full((self.warmup_size, self.warmup_size, 3), 114, dtype=np.uint8)
+        for _ in range(self.warmup_runs):
+            model.predict(source=[blank], save=False, verbose=False)
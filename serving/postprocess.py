@@ -0,0 +1,21 @@
+def detections(result) -> list:
+    """
+    Class, confidence and xyxy box of every detection, converted in one pass per tensor
+    """
+    class_ids = result.boxes.cls.int().tolist()
+    confidences = result.boxes.conf.tolist()
+    boxes = result.boxes.xyxy.tolist()
+    return [
+        {"class_id": result.names[class_id], "confidence": confidence, "box": box}
+        for class_id, confidence, box in zip(class_ids, confidences, boxes)
+    ]
+
+
+def shade_flag(result):
+    """
+    1 when the most confident box is shaded, 0 when it is not, "" when nothing was detected
+    """
+    if len(result) == 0:
+        return ""
+    best = result.boxes.conf.argmax()
+    return int(result.names[int(result.boxes.cls[best])] == 'shade')
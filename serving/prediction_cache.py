@@ -0,0 +1,79 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+    Bounded LRU of prediction responses keyed by image content and model version
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 3600.0):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image_bytes: bytes, model_version: str) -> str:
+        return f"{hashlib.sha256(image_bytes).hexdigest()}:{model_version}"
+
+    def get(self, key: str, accept=None):
+        """
+        Return the cached value, or None on a miss or an expired entry.
+        A value rejected by accept(value) also counts as a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None or (accept is not None and not accept(entry[0])):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, value, size_bytes: int):
+        """
+        Store a value, evicting the least recently used entries past max_bytes
+        """
+        if size_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size_bytes, time.monotonic() + self.ttl_seconds)
+            self._size_bytes += size_bytes
+            while self._size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self, *args):
+        """
+        Drop every entry, registered as a model swap listener so stale versions go at once
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: str):
+        _, size_bytes, _ = self._entries.pop(key)
+        self._size_bytes -= size_bytes
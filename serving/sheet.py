@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+import torchvision
+
+
+def tile_image(image_array, tile_size: int = 640, overlap: int = 128):
+    """
+    Cut an HxWx3 array into overlapping tiles, returns the tiles and their (x, y) offsets.
+    Images that already fit in one tile are returned whole.
+    """
+    height, width = image_array.shape[:2]
+    stride = max(tile_size - overlap, 1)
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, stride))
+        return positions + [length - tile_size]
+
+    tiles, offsets = [], []
+    for y in starts(height):
+        for x in starts(width):
+            tiles.append(np.ascontiguousarray(image_array[y:y + tile_size, x:x + tile_size]))
+            offsets.append((x, y))
+    return tiles, np.array(offsets, dtype=np.float32).reshape(-1, 2)
+
+
+def merge_detections(tile_results, offsets, image_shape, tile_size: int = 640,
+                     edge_margin: float = 2.0, iou_threshold: float = 0.5):
+    """
+    Move tile detections into sheet coordinates and drop the duplicates from overlapping tiles.
+    Boxes cut by an inner tile edge are discarded, the neighbouring tile sees them whole.
+    Returns xyxy boxes, confidences and class ids.
+    """
+    height, width = image_shape[:2]
+    boxes, confidences, class_ids = [], [], []
+    for result, (x0, y0) in zip(tile_results, offsets):
+        tile_boxes = result.boxes.xyxy.cpu().numpy().astype(np.float32)
+        tile_height, tile_width = result.orig_shape
+        inner_edges = np.array([
+            x0 > 0, y0 > 0, x0 + tile_width < width, y0 + tile_height < height,
+        ])
+        touches = np.stack([
+            tile_boxes[:, 0] <= edge_margin,
+            tile_boxes[:, 1] <= edge_margin,
+            tile_boxes[:, 2] >= tile_width - edge_margin,
+            tile_boxes[:, 3] >= tile_height - edge_margin,
+        ], axis=1)
+        keep = ~(touches & inner_edges).any(axis=1)
+
+        boxes.append(tile_boxes[keep] + np.array([x0, y0, x0, y0], dtype=np.float32))
+        confidences.append(result.boxes.conf.cpu().numpy().astype(np.float32)[keep])
+        class_ids.append(result.boxes.cls.cpu().numpy()[keep].astype(np.int64))
+
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32)
+    confidences = np.concatenate(confidences) if confidences else np.zeros(0, dtype=np.float32)
+    class_ids = np.concatenate(class_ids) if class_ids else np.zeros(0, dtype=np.int64)
+
+    if len(offsets) > 1 and len(boxes):
+        keep = torchvision.ops.nms(torch.from_numpy(boxes), torch.from_numpy(confidences), iou_threshold).numpy()
+        keep.sort()
+        boxes, confidences, class_ids = boxes[keep], confidences[keep], class_ids[keep]
+    return boxes, confidences, class_ids
+
+
+def cluster_positions(values, gap):
+    """
+    Group 1-D positions into ordered clusters wherever consecutive sorted values jump by more than gap
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(values, kind="stable")
+    cluster_of_sorted = np.concatenate([[0], np.cumsum(np.diff(values[order]) > gap)])
+    clusters = np.empty(len(values), dtype=np.int64)
+    clusters[order] = cluster_of_sorted
+    return clusters
+
+
+def assign_grid(boxes, options_per_question: int = None, block_gap: float = 2.5):
+    """
+    Map each box to a (question, option) cell, returns questions, options and whether the grid is complete.
+    Rows of bubbles are questions and columns are options. With options_per_question, sheets
+    with several question blocks side by side are numbered block by block, top to bottom.
+    Blocks are split where the gap between columns is over block_gap times the option spacing,
+    and options are numbered from their distance to the block's first column, so a column without
+    any detection does not shift the others. The grid is incomplete when a block is missing a
+    column or a row, its numbering may then be off and the answers need checking.
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), False
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    box_width = np.median(boxes[:, 2] - boxes[:, 0])
+    box_height = np.median(boxes[:, 3] - boxes[:, 1])
+
+    rows = cluster_positions(centers_y, box_height / 2)
+    columns = cluster_positions(centers_x, box_width / 2)
+    if not options_per_question:
+        return rows, columns, True
+
+    number_of_rows = rows.max() + 1
+    column_centers = np.bincount(columns, weights=centers_x) / np.bincount(columns)
+    gaps = np.diff(column_centers)
+    spacing = np.median(gaps) if len(gaps) else box_width
+    block_starts = np.concatenate([[True], gaps > block_gap * spacing])
+    column_blocks = np.cumsum(block_starts) - 1
+    if (~block_starts[1:]).any():
+        spacing = np.median(gaps[~block_starts[1:]])
+
+    column_options = np.zeros(len(column_centers), dtype=np.int64)
+    complete = True
+    for block in range(column_blocks.max() + 1):
+        block_columns = np.flatnonzero(column_blocks == block)
+        block_centers = column_centers[block_columns]
+        column_options[block_columns] = np.rint((block_centers - block_centers[0]) / spacing).astype(np.int64)
+        block_rows = np.unique(rows[np.isin(columns, block_columns)])
+        if (len(block_columns) != options_per_question or column_options[block_columns[-1]] != options_per_question - 1
+                or len(block_rows) != number_of_rows):
+            complete = False
+    return column_blocks[columns] * number_of_rows + rows, column_options[columns], complete
+
+
+def score_sheet(image_array, batcher, options_per_question: int = None, tile_size: int = 640, overlap: int = 128):
+    """
+    Detect every bubble of a full answer sheet in one batched pass and lay them out on the grid.
+    image_array is a BGR array, the channel order ultralytics expects from numpy input.
+    """
+    tiles, offsets = tile_image(image_array, tile_size, overlap)
+    # Tiles are submitted together so the batcher runs them in as few model calls as possible
+    predictions = [future.result() for future in batcher.submit_many(tiles)]
+    tile_results = [result for result, _ in predictions]
+    model_version = predictions[0][1]
+    names = tile_results[0].names
+
+    boxes, confidences, class_ids = merge_detections(tile_results, offsets, image_array.shape, tile_size)
+    questions, options, grid_complete = assign_grid(boxes, options_per_question)
+
+    detections = []
+    answers = {}
+    for box, confidence, class_id, question, option in zip(boxes.tolist(), confidences.tolist(),
+                                                           class_ids.tolist(), questions.tolist(), options.tolist()):
+        flag = int(names[class_id] == 'shade')
+        detections.append({
+            "question": question,
+            "option": option,
+            "class_id": names[class_id],
+            "flag": flag,
+            "confidence": confidence,
+            "box": box,
+        })
+        answers.setdefault(question, [])
+        if flag:
+            answers[question].append(option)
+    return {"detections": detections, "answers": dict(sorted(answers.items())), "grid_incomplete": not grid_complete,
+            "model_version": model_version}
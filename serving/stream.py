@@ -0,0 +1,36 @@
+import threading
+
+# WebSocket close code asking the client to reconnect later
+TRY_AGAIN_LATER = 1013
+
+
+class StreamLimit:
+    """
+    Cap on the streams served at once. Every open WebSocket holds a request thread of its
+    worker, without a cap enough cameras would leave none for the HTTP routes.
+    """
+    def __init__(self, max_streams: int):
+        self.max_streams = max_streams
+        self._slots = threading.BoundedSemaphore(max_streams)
+
+    def try_acquire(self) -> bool:
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+
+def next_latest_frame(ws):
+    """
+    Block until a frame arrives, then drain the frames queued behind it and keep only the newest.
+    Returns that frame as received (bytes or str) and the number of stale frames dropped.
+    """
+    frame = ws.receive()
+    dropped = 0
+    while True:
+        newer = ws.receive(timeout=0)
+        if newer is None:
+            break
+        frame = newer
+        dropped += 1
+    return frame, dropped
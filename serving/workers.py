@@ -0,0 +1,53 @@
+import os
+import json
+import signal
+
+RELOAD_REQUEST_PATH = os.path.join(os.getcwd(), "runs", "serving", "reload.json")
+# Set in every gunicorn worker by gunicorn.conf.py, absent under the development server
+SERVER_PID_ENV = "OMR_SERVER_PID"
+
+
+def available_cores() -> int:
+    """
+    Cores this process may run on, honouring CPU affinity and container cpusets
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def server_pid() -> int:
+    """
+    Pid of the gunicorn master serving this worker, None outside gunicorn
+    """
+    pid = os.environ.get(SERVER_PID_ENV)
+    return int(pid) if pid else None
+
+
+def request_reload(weights_path: str, reload_path: str = RELOAD_REQUEST_PATH):
+    """
+    Ask the master to load new weights, then replace its workers with ones forked from it.
+    Raises RuntimeError while an earlier request is still being handled.
+    """
+    os.makedirs(os.path.dirname(reload_path), exist_ok=True)
+    try:
+        fd = os.open(reload_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        raise RuntimeError("A model is already being loaded")
+    with os.fdopen(fd, 'w') as reload_file:
+        json.dump({"weights": weights_path}, reload_file)
+    os.kill(server_pid(), signal.SIGHUP)
+
+
+def take_reload_request(reload_path: str = RELOAD_REQUEST_PATH) -> str:
+    """
+    Weights asked for by request_reload, None when the reload was a plain HUP.
+    The request file is removed so the next reload can be asked for.
+    """
+    if not os.path.exists(reload_path):
+        return None
+    try:
+        with open(reload_path, 'r') as reload_file:
+            return json.load(reload_file).get("weights")
+    finally:
+        os.remove(reload_path)
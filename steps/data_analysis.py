@@ -0,0 +1,185 @@
+import os
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import yaml
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from steps.data_split import SPLITS, SPLIT_MANIFEST_FILE_NAME
+
+BOX_DTYPE = np.dtype([
+    ("image_id", "<i4"),
+    ("class_id", "<i2"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("w", "<f4"),
+    ("h", "<f4"),
+])
+IMAGE_DTYPE = np.dtype([
+    ("split", "<i1"),
+    ("status", "<i1"),
+    ("num_boxes", "<i4"),
+])
+
+# Image status codes stored in the index
+STATUS_OK = 0
+STATUS_EMPTY = 1
+STATUS_CORRUPT = 2
+STATUS_MISSING = 3
+STATUS_NAMES = ["ok", "empty", "corrupt", "missing"]
+
+CHUNK_SIZE = 1000
+SIZE_BINS = np.linspace(0.0, 1.0, 41)
+
+
+def parse_label_files(first_image_id, label_paths):
+    """
+    Parse a chunk of YOLO label files, returns the boxes and the per image status.
+    Runs in a worker process, a file with any malformed line is flagged corrupt and
+    contributes no boxes.
+    """
+    boxes = []
+    statuses = np.zeros(len(label_paths), dtype=np.int8)
+    for offset, label_path in enumerate(label_paths):
+        if not os.path.exists(label_path):
+            statuses[offset] = STATUS_MISSING
+            continue
+        with open(label_path, 'r') as label_file:
+            lines = [line.split() for line in label_file if line.strip()]
+        try:
+            rows = [(int(fields[0]), *map(float, fields[1:5])) for fields in lines if len(fields) == 5]
+            if len(rows) != len(lines) or any(row[0] < 0 for row in rows):
+                raise ValueError(label_path)
+        except ValueError:
+            statuses[offset] = STATUS_CORRUPT
+            continue
+        if not rows:
+            statuses[offset] = STATUS_EMPTY
+            continue
+        coords = np.array([row[1:] for row in rows], dtype=np.float32)
+        if ((coords < 0) | (coords > 1)).any():
+            statuses[offset] = STATUS_CORRUPT
+            continue
+        boxes.extend((first_image_id + offset, *row) for row in rows)
+    return np.array(boxes, dtype=BOX_DTYPE), statuses
+
+
+def build_label_index(labels_folder, split_manifest, index_folder, workers=None):
+    """
+    Parse every label file in parallel into an array-backed index stored as .npy files
+    """
+    image_names = sorted(split_manifest)
+    label_paths = [os.path.join(labels_folder, name.replace(".jpg", ".txt")) for name in image_names]
+
+    images = np.zeros(len(image_names), dtype=IMAGE_DTYPE)
+    images["split"] = [SPLITS.index(split_manifest[name]["split"]) for name in image_names]
+
+    box_chunks = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        starts = range(0, len(label_paths), CHUNK_SIZE)
+        chunks = executor.map(parse_label_files, starts, [label_paths[i:i + CHUNK_SIZE] for i in starts])
+        for start, (chunk_boxes, chunk_statuses) in zip(starts, chunks):
+            images["status"][start:start + len(chunk_statuses)] = chunk_statuses
+            box_chunks.append(chunk_boxes)
+    boxes = np.concatenate(box_chunks) if box_chunks else np.zeros(0, dtype=BOX_DTYPE)
+    images["num_boxes"] = np.bincount(boxes["image_id"], minlength=len(images))
+
+    os.makedirs(index_folder, exist_ok=True)
+    np.save(os.path.join(index_folder, "boxes.npy"), boxes)
+    np.save(os.path.join(index_folder, "images.npy"), images)
+    with open(os.path.join(index_folder, "image_names.json"), 'w') as names_file:
+        json.dump(image_names, names_file)
+    logging.info(f"Indexed {len(boxes)} boxes from {len(images)} label files into {index_folder}")
+
+
+def load_label_index(index_folder):
+    """
+    Memory-map the label index, nothing is read until the arrays are used
+    """
+    boxes = np.load(os.path.join(index_folder, "boxes.npy"), mmap_mode="r")
+    images = np.load(os.path.join(index_folder, "images.npy"), mmap_mode="r")
+    return boxes, images
+
+
+def compute_statistics(boxes, images, num_classes):
+    """
+    Per split class counts, box size histograms and label health, all vectorized
+    """
+    box_split = images["split"][boxes["image_id"]].astype(np.int64)
+    class_id = np.clip(boxes["class_id"].astype(np.int64), 0, num_classes)
+    # Class ids past the names in data.yaml are counted in one extra "unknown" column
+    class_counts = np.bincount(box_split * (num_classes + 1) + class_id,
+                               minlength=len(SPLITS) * (num_classes + 1)).reshape(len(SPLITS), num_classes + 1)
+    status_counts = np.bincount(images["split"].astype(np.int64) * len(STATUS_NAMES) + images["status"],
+                                minlength=len(SPLITS) * len(STATUS_NAMES)).reshape(len(SPLITS), len(STATUS_NAMES))
+
+    statistics = {}
+    for split_id, split in enumerate(SPLITS):
+        in_split = box_split == split_id
+        widths = boxes["w"][in_split]
+        heights = boxes["h"][in_split]
+        statistics[split] = {
+            "class_counts": class_counts[split_id],
+            "status_counts": status_counts[split_id],
+            "width_histogram": np.histogram(widths, bins=SIZE_BINS)[0],
+            "height_histogram": np.histogram(heights, bins=SIZE_BINS)[0],
+            "size_histogram_2d": np.histogram2d(widths, heights, bins=[SIZE_BINS, SIZE_BINS])[0],
+        }
+    return statistics
+
+
+def plot_statistics(split, split_statistics, class_names, output_path):
+    fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+
+    names = class_names + ["unknown"]
+    axes[0].bar(names, split_statistics["class_counts"])
+    axes[0].set_title(f"{split}: boxes per class")
+    status_text = ", ".join(f"{name}: {count}" for name, count in zip(STATUS_NAMES, split_statistics["status_counts"]))
+    axes[0].set_xlabel(status_text)
+
+    centers = (SIZE_BINS[:-1] + SIZE_BINS[1:]) / 2
+    width = SIZE_BINS[1] - SIZE_BINS[0]
+    axes[1].bar(centers, split_statistics["width_histogram"], width=width, alpha=0.6, label="width")
+    axes[1].bar(centers, split_statistics["height_histogram"], width=width, alpha=0.6, label="height")
+    axes[1].set_title(f"{split}: box size (normalized)")
+    axes[1].legend()
+
+    axes[2].imshow(split_statistics["size_histogram_2d"].T, origin="lower", extent=[0, 1, 0, 1], cmap="Blues")
+    axes[2].set_title(f"{split}: box width vs height")
+    axes[2].set_xlabel("width")
+    axes[2].set_ylabel("height")
+
+    fig.tight_layout()
+    fig.savefig(output_path)
+    plt.close(fig)
+
+
+def data_analysis():
+    current_folder = os.getcwd()
+    labels_folder = os.path.join(current_folder, 'datasets_temp', 'labels')
+    index_folder = os.path.join(current_folder, 'datasets', 'label_index')
+
+    with open(os.path.join(current_folder, 'datasets', SPLIT_MANIFEST_FILE_NAME), 'r') as manifest_file:
+        split_manifest = json.load(manifest_file)
+    with open(os.path.join(current_folder, 'datasets', 'data.yaml'), 'r') as yaml_file:
+        class_names = list(yaml.safe_load(yaml_file).get('names') or [])
+
+    build_label_index(labels_folder, split_manifest, index_folder)
+    boxes, images = load_label_index(index_folder)
+    statistics = compute_statistics(boxes, images, len(class_names))
+
+    summary = {}
+    for split, split_statistics in statistics.items():
+        plot_statistics(split, split_statistics, class_names,
+                        os.path.join(current_folder, f"data_{split}_analysis.png"))
+        summary[split] = {
+            "class_counts": dict(zip(class_names + ["unknown"], split_statistics["class_counts"].tolist())),
+            "status_counts": dict(zip(STATUS_NAMES, split_statistics["status_counts"].tolist())),
+        }
+    with open(os.path.join(index_folder, "statistics.json"), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print(f"Data analysis written for {', '.join(SPLITS)}")
@@ -0,0 +1,328 @@
+"""
+Pack a dataset folder (images/, labels/, notes.json, classes.txt) into a few large tar shards plus
+index.json, so ingestion makes one request per shard instead of one per file.
+
+    python -m steps.data_archive DATASET_FOLDER OUTPUT_FOLDER
+    python -m steps.data_archive DATASET_FOLDER s3://bucket/prefix --endpoint-url http://localhost:9000
+
+Packing again into the same place is append-only: files keep the shard they were packed in, new
+files go into the last shard while it has room and then into new shards, and a shard is only
+rewritten when one of its files changed or was removed. Ingestion then streams just those shards.
+--repack ignores the previous index and packs everything afresh.
+"""
+import os
+import json
+import math
+import shutil
+import hashlib
+import logging
+import tarfile
+import argparse
+import tempfile
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+INDEX_FILE_NAME = "index.json"
+ARCHIVE_MANIFEST_FILE_NAME = "archive_manifest.json"
+DATASET_FILE_NAMES = ("notes.json", "classes.txt")
+DATASET_FOLDERS = ("images", "labels")
+TAR_BLOCK_SIZE = 512
+
+
+def member_local_path(member_name, datasets_folder):
+    """
+    Where an archive member goes inside datasets_temp, None for members we do not ingest
+    """
+    folder, _, file_name = member_name.partition('/')
+    if folder in DATASET_FOLDERS and file_name and '/' not in file_name:
+        return os.path.join(datasets_folder, folder, file_name)
+    if member_name in DATASET_FILE_NAMES:
+        return os.path.join(datasets_folder, member_name)
+    return None
+
+
+def dataset_members(dataset_folder):
+    """
+    Archive member names of every dataset file, relative to the dataset folder
+    """
+    members = [file_name for file_name in DATASET_FILE_NAMES if os.path.isfile(os.path.join(dataset_folder, file_name))]
+    for folder in DATASET_FOLDERS:
+        folder_path = os.path.join(dataset_folder, folder)
+        if os.path.isdir(folder_path):
+            members.extend(f"{folder}/{file_name}" for file_name in sorted(os.listdir(folder_path))
+                           if os.path.isfile(os.path.join(folder_path, file_name)))
+    return members
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def write_shard(shard_path, dataset_folder, members):
+    """
+    Write members into one uncompressed tar, JPEGs don't compress, returns the data offset and
+    size of each member so a single file can also be fetched with a range read
+    """
+    offsets = {}
+    with tarfile.open(shard_path + ".tmp", "w", format=tarfile.PAX_FORMAT) as tar:
+        for member in members:
+            tar.add(os.path.join(dataset_folder, member), arcname=member, recursive=False)
+            size = tar.members[-1].size
+            # After add the offset sits past the member's data, padded to whole blocks
+            offsets[member] = {"offset": tar.offset - math.ceil(size / TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE,
+                               "size": size}
+    os.replace(shard_path + ".tmp", shard_path)
+    return offsets
+
+
+def shard_number(shard_name):
+    return int(shard_name[len("shard-"):-len(".tar")])
+
+
+def plan_shards(members, sizes, digests, previous_index, shard_bytes):
+    """
+    Members of every shard after this pack, and the shards that have to be (re)written.
+    Files of the previous index stay in their shard, new files fill the last shard up to
+    shard_bytes, then new shards. Files sharing a name stem (an image and its label) are kept together.
+    """
+    previous_files = previous_index["files"] if previous_index else {}
+    shard_order = [shard["name"] for shard in previous_index["shards"]] if previous_index else []
+    shard_members = {name: [] for name in shard_order}
+    for member in members:
+        if member in previous_files:
+            shard_members[previous_files[member]["shard"]].append(member)
+    dirty = {entry["shard"] for member, entry in previous_files.items()
+             if digests.get(member) != entry.get("sha256")}
+
+    groups = {}
+    for member in members:
+        if member not in previous_files:
+            groups.setdefault(os.path.splitext(os.path.basename(member))[0], []).append(member)
+    next_number = max((shard_number(name) for name in shard_order), default=-1) + 1
+    current = shard_order[-1] if shard_order else None
+    current_bytes = sum(sizes[member] for member in shard_members[current]) if current else 0
+    for group in groups.values():
+        group_bytes = sum(sizes[member] for member in group)
+        if current is None or (current_bytes and current_bytes + group_bytes > shard_bytes):
+            current = f"shard-{next_number:05d}.tar"
+            next_number += 1
+            shard_order.append(current)
+            shard_members[current] = []
+            current_bytes = 0
+        shard_members[current].extend(group)
+        current_bytes += group_bytes
+        dirty.add(current)
+
+    shard_order = [name for name in shard_order if shard_members[name]]
+    return [(name, sorted(shard_members[name])) for name in shard_order], dirty
+
+
+def pack_dataset(dataset_folder, output_folder, shard_size_mb=256, previous_index=None, repack=False):
+    """
+    Pack the dataset into tar shards of about shard_size_mb each and write their index.
+    Appends to previous_index, or to the index already in output_folder, unless repack.
+    Returns the index and the names of the shards written to output_folder.
+    """
+    members = dataset_members(dataset_folder)
+    if not members:
+        raise ValueError(f"No dataset files in {dataset_folder}")
+    sizes = {member: os.path.getsize(os.path.join(dataset_folder, member)) for member in members}
+    digests = {member: file_sha256(os.path.join(dataset_folder, member)) for member in members}
+
+    os.makedirs(output_folder, exist_ok=True)
+    index_path = os.path.join(output_folder, INDEX_FILE_NAME)
+    # Shards of an index read from output_folder itself have to be there, or they are written again
+    local_previous = previous_index is None and os.path.exists(index_path)
+    if local_previous:
+        with open(index_path, 'r') as index_file:
+            previous_index = json.load(index_file)
+    if repack:
+        previous_index = None
+    plan, dirty = plan_shards(members, sizes, digests, previous_index, shard_size_mb * 1024 * 1024)
+
+    previous_shards = {shard["name"]: shard for shard in previous_index["shards"]} if previous_index else {}
+    index = {"shards": [], "files": {}}
+    written = []
+    for shard_name, names in tqdm(plan, desc="shards", unit="shard"):
+        shard_path = os.path.join(output_folder, shard_name)
+        if shard_name not in dirty and not (local_previous and not os.path.exists(shard_path)):
+            index["shards"].append(previous_shards[shard_name])
+            index["files"].update({member: previous_index["files"][member] for member in names})
+            continue
+        for member, location in write_shard(shard_path, dataset_folder, names).items():
+            index["files"][member] = {"shard": shard_name, **location, "sha256": digests[member]}
+        index["shards"].append({"name": shard_name, "files": len(names), "size": os.path.getsize(shard_path),
+                                "sha256": file_sha256(shard_path)})
+        written.append(shard_name)
+
+    with open(index_path + ".tmp", 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path + ".tmp", index_path)
+    kept = {shard["name"] for shard in index["shards"]}
+    for file_name in os.listdir(output_folder):
+        if file_name.startswith("shard-") and file_name.endswith(".tar") and file_name not in kept:
+            os.remove(os.path.join(output_folder, file_name))
+    logging.info(f"Packed {len(members)} files, {sum(sizes.values()) / 1024 / 1024:.1f} MB, into "
+                 f"{len(index['shards'])} shards, {len(written)} written")
+    return index, written
+
+
+class LocalArchive:
+    """
+    Packed dataset in a local folder
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def read_index(self):
+        with open(os.path.join(self.folder, INDEX_FILE_NAME), 'r') as index_file:
+            return json.load(index_file)
+
+    def open(self, name):
+        return open(os.path.join(self.folder, name), 'rb')
+
+
+class S3Archive:
+    """
+    Packed dataset under an S3 prefix, shards are read as one streamed GET each
+    """
+    def __init__(self, s3_client, bucket, prefix):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def key(self, name):
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def read_index(self):
+        return json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=self.key(INDEX_FILE_NAME))['Body'].read())
+
+    def read_index_if_any(self):
+        try:
+            return self.read_index()
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+
+    def open(self, name):
+        return closing(self.s3_client.get_object(Bucket=self.bucket, Key=self.key(name))['Body'])
+
+    def upload(self, folder, index, shard_names):
+        """
+        Upload the named shards of a packed folder, the others are already there.
+        The index goes last, so a reader never sees an index naming shards that are not uploaded yet.
+        """
+        for shard_name in shard_names:
+            self.s3_client.upload_file(os.path.join(folder, shard_name), self.bucket, self.key(shard_name))
+        self.s3_client.upload_file(os.path.join(folder, INDEX_FILE_NAME), self.bucket, self.key(INDEX_FILE_NAME))
+
+    def remove(self, shard_names):
+        for shard_name in shard_names:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=self.key(shard_name))
+
+
+def extract_shard(archive, shard_name, datasets_folder):
+    """
+    Stream one shard and write its members into datasets_temp as they arrive, returns the bytes written
+    """
+    written = 0
+    with archive.open(shard_name) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            local_path = member_local_path(member.name, datasets_folder) if member.isfile() else None
+            if local_path is None:
+                continue
+            # A new file instead of rewriting in place, hardlinks made by the split step keep the old bytes
+            with tar.extractfile(member) as source, open(local_path + ".tmp", 'wb') as local_file:
+                shutil.copyfileobj(source, local_file, 1 << 20)
+            os.replace(local_path + ".tmp", local_path)
+            written += member.size
+    return written
+
+
+def ingest_archive(archive, datasets_folder, workers=4):
+    """
+    Bring datasets_temp in line with a packed dataset. Shards whose content changed since the last
+    ingestion, or with files missing locally, are streamed again, files no longer in the index are deleted.
+    """
+    index = archive.read_index()
+    for folder in DATASET_FOLDERS:
+        os.makedirs(os.path.join(datasets_folder, folder), exist_ok=True)
+    manifest_path = os.path.join(datasets_folder, ARCHIVE_MANIFEST_FILE_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+    expected = {member_local_path(member, datasets_folder): location["shard"]
+                for member, location in index["files"].items()}
+    expected.pop(None, None)
+    removed = 0
+    for folder in DATASET_FOLDERS:
+        folder_path = os.path.join(datasets_folder, folder)
+        for file_name in os.listdir(folder_path):
+            if os.path.join(folder_path, file_name) not in expected:
+                os.remove(os.path.join(folder_path, file_name))
+                removed += 1
+
+    missing_shards = {shard for local_path, shard in expected.items() if not os.path.exists(local_path)}
+    changed = [shard for shard in index["shards"]
+               if manifest.get(shard["name"]) != shard["sha256"] or shard["name"] in missing_shards]
+    manifest = {shard["name"]: manifest[shard["name"]] for shard in index["shards"] if shard["name"] in manifest}
+    logging.info(f"{len(index['shards'])} shards, {len(changed)} new or changed, {removed} files removed")
+
+    try:
+        with tqdm(total=sum(shard["size"] for shard in changed), unit='B', unit_scale=True, unit_divisor=1024,
+                  desc="shards") as progress, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(extract_shard, archive, shard["name"], datasets_folder): shard
+                       for shard in changed}
+            for future in as_completed(futures):
+                future.result()
+                shard = futures[future]
+                manifest[shard["name"]] = shard["sha256"]
+                progress.update(shard["size"])
+    finally:
+        # Keep the shards extracted so far, an interrupted ingestion resumes where it stopped
+        # Sorted, shards finish in any order and the step runner hashes this file
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    print(f"Finish ingest archive into {datasets_folder}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset_folder", help="Folder with images/, labels/, notes.json and classes.txt")
+    parser.add_argument("output", help="Output folder, or s3://bucket/prefix to upload the shards there")
+    parser.add_argument("--shard-size-mb", type=int, default=256)
+    parser.add_argument("--repack", action="store_true", help="Ignore the previous index and pack everything again")
+    parser.add_argument("--endpoint-url", default=None, help="S3 compatible endpoint, e.g. a local stand-in")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not args.output.startswith("s3://"):
+        pack_dataset(args.dataset_folder, args.output, args.shard_size_mb, repack=args.repack)
+        return
+
+    import boto3
+    bucket, _, prefix = args.output[len("s3://"):].partition('/')
+    archive = S3Archive(boto3.client('s3', endpoint_url=args.endpoint_url), bucket, prefix)
+    with tempfile.TemporaryDirectory() as output_folder:
+        previous_index = archive.read_index_if_any()
+        index, written = pack_dataset(args.dataset_folder, output_folder, args.shard_size_mb,
+                                      previous_index=previous_index, repack=args.repack)
+        archive.upload(output_folder, index, written)
+    # Only once the new index is up, shards it no longer names are deleted
+    if previous_index:
+        archive.remove({shard["name"] for shard in previous_index["shards"]}
+                       - {shard["name"] for shard in index["shards"]})
+    print(f"Uploaded {len(written)} of {len(index['shards'])} shards to {args.output}, "
+          f"{len(index['shards']) - len(written)} unchanged")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,38 @@
 import logging
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import os
 import configparser
 from pathlib import Path
 import yaml
 from tqdm import tqdm
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from steps.data_archive import LocalArchive, S3Archive, ingest_archive
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 confp = configparser.RawConfigParser()
 confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
 
-aws_access_key_id = confp.get("aws","aws_access_key_id")
-aws_secret_access_key = confp.get("aws","aws_secret_access_key")
+# Without keys boto3 falls back to its own credential chain, a local archive needs none
+aws_access_key_id = confp.get("aws","aws_access_key_id", fallback=None)
+aws_secret_access_key = confp.get("aws","aws_secret_access_key", fallback=None)
 bucket_name = confp.get("s3","bucket")
 datasets_path_s3 = confp.get("s3", "datasets_path")
 datasets_folder_local = confp.get("local", "datasets_local_path")
+download_workers = confp.getint("s3", "download_workers", fallback=16)
+# An S3 compatible endpoint, e.g. a local stand-in for testing, instead of AWS
+endpoint_url = confp.get("s3", "endpoint_url", fallback=None)
+# Ingest the tar shards written by steps/data_archive instead of one object per file,
+# from this prefix of the bucket, or from this local folder when archive_folder is set
+archive_path_s3 = confp.get("s3", "archive_path", fallback=None)
+archive_folder_local = confp.get("local", "archive_folder", fallback=None)
+archive_workers = confp.getint("s3", "archive_workers", fallback=4)
+# Parallelism comes from the download pool, so each transfer runs inline in its worker thread
+transfer_config = TransferConfig(use_threads=False)
+MANIFEST_FILE_NAME = 'manifest.json'
 
 
 class IngestData:
@@ -101,73 +118,117 @@ class IngestData:
 
 
     def get_s3_connection(self, aws_access_key_id, aws_secret_access_key):
-        s3_session = boto3.client('s3', aws_access_key_id = aws_access_key_id, aws_secret_access_key = aws_secret_access_key)
+        # A single client is shared by every download thread, give each thread a pooled connection
+        s3_session = boto3.client('s3', aws_access_key_id = aws_access_key_id, aws_secret_access_key = aws_secret_access_key,
+                                  endpoint_url=endpoint_url, config=Config(max_pool_connections=download_workers))
         return s3_session
 
-    def download_images(self):
-        s3_path_images = self.datasets_path_s3 + '/images/'
-        current_folder = os.getcwd()
-        folder_path_images = os.path.join(current_folder, "datasets_temp/images")
-        print(folder_path_images, bucket_name, s3_path_images)
-
-        objects = self.s3_session.list_objects(Bucket=bucket_name, Prefix=s3_path_images)['Contents']
-        for index, obj in enumerate(objects):
-            if index == 0:
-                continue  # Skip the first iteration
-            key = obj['Key']
-            local_file_path = os.path.join(folder_path_images, os.path.basename(key))
-            self.s3_session.download_file(bucket_name, key, local_file_path)
-            # print(f'Downloaded: {key} to {local_file_path}')
-        print(f"Finish download images {folder_path_images}")
-
-    def download_labels(self):
-        s3_path_images = self.datasets_path_s3 + "/labels/"
-        current_folder = os.getcwd()
-        folder_path_labels = os.path.join(current_folder, "datasets_temp/labels")
-        print(folder_path_labels, bucket_name, s3_path_images)
-
-        objects = self.s3_session.list_objects(Bucket=bucket_name, Prefix=s3_path_images)['Contents']
-        for index, obj in enumerate(objects):
-            if index == 0:
-                continue  # Skip the first iteration
-            key = obj['Key']
-            local_file_path = os.path.join(folder_path_labels, os.path.basename(key))
-            self.s3_session.download_file(bucket_name, key, local_file_path)
-            # print(f'Downloaded: {key} to {local_file_path}')
-        print(f"Finish download labels {folder_path_labels}")
-
-    def get_json_file(self):
+    def list_objects(self, s3_prefix):
         """
-        Ingesting the json file from the datasets_path
+        List every object under the prefix, following pagination past the 1000 keys per call limit
         """
-        json_s3_path = self.datasets_path_s3 + '/notes.json'
-        current_folder = os.getcwd()
-        json_local_path = os.path.join(current_folder, 'datasets_temp/notes.json')
-
-        s3 = boto3.client('s3', aws_access_key_id = aws_access_key_id, aws_secret_access_key = aws_secret_access_key)
-        objects = s3.list_objects(Bucket=bucket_name, Prefix=json_s3_path)['Contents']
-        s3.download_file(bucket_name, json_s3_path, json_local_path)
-        logging.info(f"Finish download json file {json_local_path}")
-
-    def get_txt_file(self):
+        objects = []
+        paginator = self.s3_session.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('/'):
+                    continue  # Skip the folder placeholder object
+                objects.append(obj)
+        return objects
+
+    def local_path_for(self, key):
         """
-        Ingesting the txt file from the datasets_path
+        Map an S3 key of the dataset to its path inside datasets_temp, None for keys we do not ingest
         """
-        txt_s3_path = self.datasets_path_s3 + '/classes.txt'
-        current_folder = os.getcwd()
-        txt_local_path = os.path.join(current_folder, 'datasets_temp/classes.txt')
-
-        s3 = boto3.client('s3', aws_access_key_id = aws_access_key_id, aws_secret_access_key = aws_secret_access_key)
-        objects = s3.list_objects(Bucket=bucket_name, Prefix=txt_s3_path)['Contents']
-        s3.download_file(bucket_name, txt_s3_path, txt_local_path)
-        logging.info(f"Finish download txt labels {txt_local_path}")
+        datasets_path_local = os.path.join(os.getcwd(), 'datasets_temp')
+        relative_key = key[len(self.datasets_path_s3) + 1:]
+        if relative_key.startswith('images/'):
+            return os.path.join(datasets_path_local, 'images', os.path.basename(key))
+        if relative_key.startswith('labels/'):
+            return os.path.join(datasets_path_local, 'labels', os.path.basename(key))
+        if relative_key in ('notes.json', 'classes.txt'):
+            return os.path.join(datasets_path_local, relative_key)
+        return None
+
+    def load_manifest(self):
+        manifest_path = os.path.join(os.getcwd(), 'datasets_temp', MANIFEST_FILE_NAME)
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+
+    def save_manifest(self, manifest):
+        manifest_path = os.path.join(os.getcwd(), 'datasets_temp', MANIFEST_FILE_NAME)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def download_objects(self, objects, desc, on_downloaded=None):
+        """
+        Download objects concurrently to their local paths, reporting progress and throughput
+        """
+        total_bytes = sum(obj['Size'] for obj in objects)
+        with tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024, desc=desc) as progress, \
+                ThreadPoolExecutor(max_workers=download_workers) as executor:
+            futures = {}
+            for obj in objects:
+                future = executor.submit(self.s3_session.download_file, bucket_name, obj['Key'],
+                                         self.local_path_for(obj['Key']), Config=transfer_config)
+                futures[future] = obj
+
+            for files_done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                progress.update(futures[future]['Size'])
+                progress.set_postfix(files=f"{files_done}/{len(objects)}", refresh=False)
+                if on_downloaded is not None:
+                    on_downloaded(futures[future])
+
+    def sync(self):
+        """
+        Bring datasets_temp in line with S3 using the local manifest.
+        Only new or changed objects are downloaded, local files whose keys vanished are deleted.
+        """
+        manifest = self.load_manifest()
+        remote = {}
+        for obj in self.list_objects(self.datasets_path_s3 + '/'):
+            if self.local_path_for(obj['Key']) is not None:
+                remote[obj['Key']] = obj
+
+        def manifest_entry(obj):
+            return {
+                "etag": obj['ETag'],
+                "size": obj['Size'],
+                "last_modified": obj['LastModified'].isoformat(),
+            }
+
+        removed_keys = [key for key in manifest if key not in remote]
+        for key in removed_keys:
+            local_file_path = self.local_path_for(key)
+            if os.path.exists(local_file_path):
+                os.remove(local_file_path)
+            del manifest[key]
+
+        changed_objects = [obj for key, obj in remote.items()
+                           if manifest.get(key) != manifest_entry(obj) or not os.path.exists(self.local_path_for(key))]
+        logging.info(f"{len(remote)} objects in S3, {len(changed_objects)} new or changed, {len(removed_keys)} removed")
+
+        try:
+            self.download_objects(changed_objects, desc="datasets",
+                                  on_downloaded=lambda obj: manifest.update({obj['Key']: manifest_entry(obj)}))
+        finally:
+            # Keep what was downloaded so far, an interrupted sync resumes where it stopped
+            self.save_manifest(manifest)
+        print(f"Finish sync datasets {os.path.join(os.getcwd(), 'datasets_temp')}")
 
 
 def ingest_df():
     ingest_data = IngestData(datasets_path_s3, aws_access_key_id, aws_secret_access_key)
     ingest_data.create_folder()
     ingest_data.create_temp_datasets_folder()
-    ingest_data.download_images()
-    ingest_data.download_labels()
-    ingest_data.get_json_file()
-    ingest_data.get_txt_file()
\ No newline at end of file
+    datasets_temp = os.path.join(os.getcwd(), 'datasets_temp')
+    if archive_folder_local:
+        ingest_archive(LocalArchive(archive_folder_local), datasets_temp, archive_workers)
+    elif archive_path_s3:
+        ingest_archive(S3Archive(ingest_data.s3_session, bucket_name, archive_path_s3), datasets_temp, archive_workers)
+    else:
+        ingest_data.sync()
@@ -1,69 +1,182 @@
 import os
 import shutil
-import random
+import hashlib
 import yaml
 import json
-
-
-def split_dataset(images_folder, labels_folder, train_ratio=0.8, test_ratio=0.1, valid_ratio=0.1):
-    # Create train, test, and valid folders
-    train_folder = "datasets/train"
-    test_folder = "datasets/test"
-    valid_folder = "datasets/valid"
-
-    os.makedirs(train_folder, exist_ok=True)
-    os.makedirs(test_folder, exist_ok=True)
-    os.makedirs(valid_folder, exist_ok=True)
-
-    # Create subfolders for images and labels in train folder
-    train_images_folder = os.path.join(train_folder, "images")
-    train_labels_folder = os.path.join(train_folder, "labels")
-    os.makedirs(train_images_folder, exist_ok=True)
-    os.makedirs(train_labels_folder, exist_ok=True)
-
-    # Create subfolders for images and labels in test folder
-    test_images_folder = os.path.join(test_folder, "images")
-    test_labels_folder = os.path.join(test_folder, "labels")
-    os.makedirs(test_images_folder, exist_ok=True)
-    os.makedirs(test_labels_folder, exist_ok=True)
-
-    # Create subfolders for images and labels in valid folder
-    valid_images_folder = os.path.join(valid_folder, "images")
-    valid_labels_folder = os.path.join(valid_folder, "labels")
-    os.makedirs(valid_images_folder, exist_ok=True)
-    os.makedirs(valid_labels_folder, exist_ok=True)
+import logging
+from collections import Counter, defaultdict
+import configparser
+from pathlib import Path
+
+confp = configparser.RawConfigParser()
+confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
+# copy, hardlink, symlink or list (YOLO image list files, nothing is materialized)
+materialize_mode = confp.get("split", "materialize", fallback="hardlink")
+
+SPLITS = ("train", "test", "valid")
+SPLIT_LIST_FILES = {"train": "train.txt", "valid": "val.txt", "test": "test.txt"}
+SPLIT_MANIFEST_FILE_NAME = "split_manifest.json"
+
+
+def materialize_file(source_path, dest_path, mode):
+    """
+    Place source_path at dest_path, linking instead of copying where the filesystem allows
+    """
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+    if mode == "hardlink":
+        try:
+            os.link(source_path, dest_path)
+            return
+        except OSError:
+            mode = "symlink"  # Cross-device or unsupported, fall back to a symlink
+    if mode == "symlink":
+        try:
+            os.symlink(source_path, dest_path)
+            return
+        except OSError:
+            pass
+    shutil.copy(source_path, dest_path)
+
+
+def clear_folder(folder):
+    for file in os.listdir(folder):
+        os.remove(os.path.join(folder, file))
+
+
+def needs_refresh(source_path, dest_path, mode):
+    """
+    Whether dest_path is missing or no longer reflects source_path
+    """
+    if not os.path.lexists(dest_path):
+        return True
+    if mode == "hardlink" and not os.path.islink(dest_path):
+        # A re-downloaded source gets a new inode, the old hardlink keeps the old bytes
+        return not os.path.samefile(source_path, dest_path)
+    if mode == "copy":
+        return os.path.getmtime(source_path) > os.path.getmtime(dest_path)
+    return False
+
+
+def read_stratum(label_path):
+    """
+    Class mix of an image, the sorted class ids found in its YOLO label file
+    """
+    if not os.path.exists(label_path):
+        return "unlabeled"
+    class_ids = set()
+    with open(label_path, 'r') as label_file:
+        for line in label_file:
+            fields = line.split()
+            if fields and fields[0].isdigit():
+                class_ids.add(int(fields[0]))
+    return ",".join(str(class_id) for class_id in sorted(class_ids)) or "empty"
+
+
+def name_hash(file):
+    return hashlib.sha1(file.encode("utf-8")).hexdigest()
+
+
+def assign_split(split_counts, ratios):
+    """
+    Pick the split lagging furthest behind its target share within the stratum
+    """
+    total = sum(split_counts.values()) + 1
+    return max(SPLITS, key=lambda split: ratios[split] * total - split_counts[split])
+
+
+def load_split_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_split_manifest(manifest, manifest_path):
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def split_dataset(images_folder, labels_folder, train_ratio=0.8, test_ratio=0.1, valid_ratio=0.1, mode=materialize_mode):
+    """
+    Split the images into train, test and valid, returns the paths to reference from data.yaml.
+
+    Assignments are kept in datasets/split_manifest.json so an image never changes split once
+    placed. New images are visited in the order of their name hash and go to the split furthest
+    behind its ratio among images with the same class mix, so every class mix is split evenly.
+    In list mode only YOLO image list files are written, otherwise the split folders are
+    filled with hardlinks, symlinks or copies of the files in datasets_temp.
+    """
+    ratios = {"train": train_ratio, "test": test_ratio, "valid": valid_ratio}
+    os.makedirs("datasets", exist_ok=True)
+    manifest_path = os.path.join("datasets", SPLIT_MANIFEST_FILE_NAME)
+    manifest = load_split_manifest(manifest_path)
+    first_run = manifest is None
+    manifest = manifest or {}
 
     # Get the list of image files
-    image_files = [f for f in os.listdir(images_folder) if f.endswith(".jpg")]
-
-    # Shuffle the list to randomize the dataset
-    random.shuffle(image_files)
-
-    # Calculate the number of files for each split
-    total_files = len(image_files)
-    train_size = int(train_ratio * total_files)
-    test_size = int(test_ratio * total_files)
-
-    # Split the dataset
-    train_files = image_files[:train_size]
-    test_files = image_files[train_size:train_size + test_size]
-    valid_files = image_files[train_size + test_size:]
-
-    # Move images and labels to respective subfolders
-    def move_files(files, source_folder, dest_images_folder, dest_labels_folder):
-        for file in files:
-            # Move images
-            shutil.copy(os.path.join(source_folder, file), os.path.join(dest_images_folder, file))
-            
-            # Move labels
-            label_file = file.replace(".jpg", ".txt")
-            shutil.copy(os.path.join(labels_folder, label_file), os.path.join(dest_labels_folder, label_file))
-
-    move_files(train_files, images_folder, train_images_folder, train_labels_folder)
-    move_files(test_files, images_folder, test_images_folder, test_labels_folder)
-    move_files(valid_files, images_folder, valid_images_folder, valid_labels_folder)
-
-def generate_yaml_from_json(json_file_path, yaml_file_path):
+    image_files = {f for f in os.listdir(images_folder) if f.endswith(".jpg")}
+
+    removed_files = {file: manifest.pop(file) for file in list(manifest) if file not in image_files}
+    new_files = sorted((f for f in image_files if f not in manifest), key=name_hash)
+
+    split_counts = defaultdict(Counter)
+    for entry in manifest.values():
+        split_counts[entry["stratum"]][entry["split"]] += 1
+
+    for file in new_files:
+        stratum = read_stratum(os.path.join(labels_folder, file.replace(".jpg", ".txt")))
+        split = assign_split(split_counts[stratum], ratios)
+        split_counts[stratum][split] += 1
+        manifest[file] = {"split": split, "stratum": stratum}
+
+    save_split_manifest(manifest, manifest_path)
+    logging.info(f"Split {len(manifest)} images, {len(new_files)} new, {len(removed_files)} removed")
+
+    if mode == "list":
+        # YOLO finds each label by swapping /images/ for /labels/ in the image path
+        split_paths = {}
+        for split in SPLITS:
+            list_file_path = os.path.abspath(os.path.join("datasets", SPLIT_LIST_FILES[split]))
+            with open(list_file_path, 'w') as list_file:
+                list_file.writelines(os.path.join(images_folder, file) + "\n"
+                                     for file in sorted(manifest) if manifest[file]["split"] == split)
+            split_paths[split] = list_file_path
+        return split_paths
+
+    # Create images and labels subfolders for train, test and valid
+    for split in SPLITS:
+        for subfolder in ("images", "labels"):
+            folder = os.path.join("datasets", split, subfolder)
+            os.makedirs(folder, exist_ok=True)
+            if first_run:
+                # Files left over from before the manifest may sit in the wrong split
+                clear_folder(folder)
+
+    for file, entry in removed_files.items():
+        for subfolder, name in (("images", file), ("labels", file.replace(".jpg", ".txt"))):
+            dest_path = os.path.join("datasets", entry["split"], subfolder, name)
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+
+    # Only new, missing or changed files are materialized again
+    for file, entry in manifest.items():
+        label_file = file.replace(".jpg", ".txt")
+        for source_path, dest_path in (
+            (os.path.join(images_folder, file), os.path.join("datasets", entry["split"], "images", file)),
+            (os.path.join(labels_folder, label_file), os.path.join("datasets", entry["split"], "labels", label_file)),
+        ):
+            if os.path.exists(source_path) and needs_refresh(source_path, dest_path, mode):
+                materialize_file(source_path, dest_path, mode)
+
+    return {
+        "train": "../train/images",
+        "valid": "../valid/images",
+        "test": "../test/images",
+    }
+
+def generate_yaml_from_json(json_file_path, yaml_file_path, split_paths):
     def count_ids(data):
         id_count = 0
         for item in data.get('categories', []):
@@ -85,9 +198,9 @@ def generate_yaml_from_json(json_file_path, yaml_file_path):
 
     # Create data dictionary
     data_dict = {
-        'train': '../train/images',
-        'val': '../valid/images',
-        'test': '../test/images',
+        'train': split_paths['train'],
+        'val': split_paths['valid'],
+        'test': split_paths['test'],
         'nc': nc,
         'names': names
     }
@@ -103,9 +216,19 @@ def split_df():
     current_folder = os.getcwd()
     images_folder = os.path.join(current_folder, 'datasets_temp', 'images')
     labels_folder = os.path.join(current_folder, 'datasets_temp', 'labels')
-    split_dataset(images_folder, labels_folder)
+    split_paths = split_dataset(images_folder, labels_folder)
 
     json_file_path = os.path.join(current_folder, 'datasets_temp', 'notes.json')
     yaml_file_path = os.path.join(current_folder, 'datasets', 'data.yaml')
-    generate_yaml_from_json(json_file_path, yaml_file_path)
+    generate_yaml_from_json(json_file_path, yaml_file_path, split_paths)
+
 
+
+def split_images(split):
+    """
+    Absolute paths of the images assigned to a split, read from the split manifest
+    """
+    current_folder = os.getcwd()
+    manifest = load_split_manifest(os.path.join(current_folder, 'datasets', SPLIT_MANIFEST_FILE_NAME)) or {}
+    images_folder = os.path.join(current_folder, 'datasets_temp', 'images')
+    return [os.path.join(images_folder, file) for file in sorted(manifest) if manifest[file]["split"] == split]
@@ -0,0 +1,190 @@
+import os
+import math
+import json
+import hashlib
+import logging
+import configparser
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from ultralytics.data.dataset import YOLODataset
+
+from steps.data_split import split_images, SPLITS
+
+confp = configparser.RawConfigParser()
+confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
+image_size = confp.getint("train", "image_size", fallback=640)
+
+CACHE_FOLDER = os.path.join("datasets", "image_cache")
+CHUNK_SIZE = 256
+INDEX_FILE_NAME = "images.npy"
+NAMES_FILE_NAME = "image_names.json"
+SOURCE_FILE_NAME = "source.json"
+
+CACHED_IMAGE_DTYPE = np.dtype([
+    ("shard", "<i4"),
+    ("offset", "<i8"),
+    ("h0", "<i4"),
+    ("w0", "<i4"),
+    ("h", "<i4"),
+    ("w", "<i4"),
+])
+
+
+def cache_folder_for(size):
+    return os.path.join(os.getcwd(), CACHE_FOLDER, str(size))
+
+
+def resize_long_side(image, size):
+    """
+    Resize so the long side is size, keeping the aspect ratio, exactly as ultralytics does when
+    it loads a training image. The square padding is added later by its letterbox transform.
+    """
+    h0, w0 = image.shape[:2]
+    ratio = size / max(h0, w0)
+    if ratio != 1:
+        w, h = min(math.ceil(w0 * ratio), size), min(math.ceil(h0 * ratio), size)
+        image = cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+    return image
+
+
+def cache_image_chunk(shard_path, image_paths, size):
+    """
+    Decode and resize a chunk of images into one raw uint8 shard file.
+    Runs in a worker process, returns offset, original and resized shape per image, an
+    unreadable image gets h = w = 0.
+    """
+    records = np.zeros(len(image_paths), dtype=CACHED_IMAGE_DTYPE)
+    offset = 0
+    with open(shard_path, 'wb') as shard_file:
+        for position, image_path in enumerate(image_paths):
+            image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+            if image is None:
+                continue
+            h0, w0 = image.shape[:2]
+            image = np.ascontiguousarray(resize_long_side(image, size))
+            shard_file.write(image.tobytes())
+            records[position] = (0, offset, h0, w0, image.shape[0], image.shape[1])
+            offset += image.nbytes
+    return records
+
+
+def images_fingerprint(image_paths):
+    """
+    Hash of the image list with each file's size and mtime, a re-downloaded image is a new file
+    and changes it even when its name does not
+    """
+    sha256 = hashlib.sha256()
+    for image_path in image_paths:
+        stat = os.stat(image_path) if os.path.exists(image_path) else None
+        sha256.update(f"{image_path}:{stat and stat.st_size}:{stat and stat.st_mtime_ns}\n".encode())
+    return sha256.hexdigest()
+
+
+def cache_is_current(image_paths, cache_folder, size):
+    """
+    Whether the cache folder was built at this size from exactly these image files
+    """
+    source_path = os.path.join(cache_folder, SOURCE_FILE_NAME)
+    if not os.path.exists(source_path):
+        return False
+    with open(source_path, 'r') as source_file:
+        source = json.load(source_file)
+    return source == {"size": size, "fingerprint": images_fingerprint(image_paths)}
+
+
+def build_image_cache(image_paths, cache_folder, size, workers=None):
+    """
+    Pre-decode and resize every image in parallel into memory-mappable shards plus an index
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    for file_name in os.listdir(cache_folder):
+        os.remove(os.path.join(cache_folder, file_name))
+
+    starts = list(range(0, len(image_paths), CHUNK_SIZE))
+    shard_paths = [os.path.join(cache_folder, f"shard_{number:05d}.bin") for number in range(len(starts))]
+    record_chunks = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(cache_image_chunk, shard_paths,
+                              [image_paths[start:start + CHUNK_SIZE] for start in starts], [size] * len(starts))
+        for number, records in enumerate(chunks):
+            records["shard"] = number
+            record_chunks.append(records)
+    records = np.concatenate(record_chunks) if record_chunks else np.zeros(0, dtype=CACHED_IMAGE_DTYPE)
+
+    np.save(os.path.join(cache_folder, INDEX_FILE_NAME), records)
+    with open(os.path.join(cache_folder, NAMES_FILE_NAME), 'w') as names_file:
+        json.dump([os.path.basename(image_path) for image_path in image_paths], names_file)
+    # Written last, an interrupted build is never taken for a current one
+    with open(os.path.join(cache_folder, SOURCE_FILE_NAME), 'w') as source_file:
+        json.dump({"size": size, "fingerprint": images_fingerprint(image_paths)}, source_file)
+    unreadable = int((records["h"] == 0).sum())
+    logging.info(f"Cached {len(records) - unreadable} images at {size}px in {len(shard_paths)} shards, "
+                 f"{unreadable} unreadable")
+
+
+class ImageCache:
+    """
+    Read side of the cache, images come straight out of the memory-mapped shards
+    """
+    def __init__(self, cache_folder):
+        self.records = np.load(os.path.join(cache_folder, INDEX_FILE_NAME))
+        with open(os.path.join(cache_folder, NAMES_FILE_NAME), 'r') as names_file:
+            self.positions = {name: position for position, name in enumerate(json.load(names_file))}
+        shard_names = sorted(name for name in os.listdir(cache_folder) if name.endswith(".bin"))
+        self.shards = [
+            np.memmap(os.path.join(cache_folder, name), dtype=np.uint8, mode="r")
+            if os.path.getsize(os.path.join(cache_folder, name)) else np.zeros(0, dtype=np.uint8)
+            for name in shard_names
+        ]
+
+    def get(self, image_path):
+        """
+        BGR image resized to the cache size with its original and resized (h, w), None if not cached
+        """
+        position = self.positions.get(os.path.basename(image_path))
+        if position is None:
+            return None
+        record = self.records[position]
+        h, w = int(record["h"]), int(record["w"])
+        if h == 0:
+            return None
+        start = int(record["offset"])
+        # Copied out of the read-only map, the augmentations edit images in place
+        image = self.shards[record["shard"]][start:start + h * w * 3].reshape(h, w, 3).copy()
+        return image, (int(record["h0"]), int(record["w0"])), (h, w)
+
+
+class CachedYOLODataset(YOLODataset):
+    """
+    YOLODataset that loads images from an ImageCache instead of decoding the JPEGs every epoch
+    """
+    def __init__(self, *args, image_cache: ImageCache = None, **kwargs):
+        self.image_cache = image_cache
+        super().__init__(*args, **kwargs)
+
+    def load_image(self, i, rect_mode=True, resize_short=False):
+        cached = None
+        if self.image_cache is not None and rect_mode and not resize_short and self.ims[i] is None:
+            cached = self.image_cache.get(self.im_files[i])
+        if cached is None:
+            return super().load_image(i, rect_mode, resize_short)
+
+        if self.augment:
+            # Mosaic draws its extra images from this buffer, it only needs the indices
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return cached
+
+
+def image_cache():
+    """
+    Cache every image of the split at the configured training image size
+    """
+    image_paths = [image_path for split in SPLITS for image_path in split_images(split)]
+    cache_folder = cache_folder_for(image_size)
+    build_image_cache(image_paths, cache_folder, image_size)
+    print(f"Image cache written to {cache_folder}")
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import logging
+import configparser
+from pathlib import Path
+
+import yaml
+import numpy as np
+from ultralytics import YOLO
+
+from serving.model_registry import promote_weights, promoted_weights
+from steps.data_split import split_images
+from steps.model_export import measure_latency
+
+confp = configparser.RawConfigParser()
+confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
+artifact_path = confp.get("mlflow", "artifact_path", fallback="runs/pipeline/train")
+batch_size = confp.getint("evaluate", "batch_size", fallback=16)
+iou_threshold = confp.getfloat("evaluate", "iou_threshold", fallback=0.5)
+# Single image calls are slow, latency is sampled on at most this many test images
+latency_images = confp.getint("evaluate", "latency_images", fallback=200)
+# The candidate may be this much slower (0.1 = 10%) at the latency percentile and still be promoted
+latency_tolerance = confp.getfloat("evaluate", "latency_tolerance", fallback=0.1)
+latency_percentile = confp.get("evaluate", "latency_percentile", fallback="p50_ms")
+baseline_weights = confp.get("evaluate", "baseline_weights", fallback="shade_v6.pt")
+# Never promoted below this test accuracy, whatever the baseline scored
+min_accuracy = confp.getfloat("evaluate", "min_accuracy", fallback=0.9)
+# Without baseline weights there is nothing to beat, promoting anyway has to be asked for
+promote_without_baseline = confp.getboolean("evaluate", "promote_without_baseline", fallback=False)
+device = confp.get("evaluate", "device", fallback="cpu")
+
+REPORT_FILE_NAME = "evaluation_report.json"
+# Rows are the labelled class, columns the predicted one, background is a missed or spurious box
+CONFUSION_LABELS = ("no_shade", "shade", "background")
+
+
+def read_label_boxes(label_path, names):
+    """
+    Shade flag and normalized xywh box of every labelled bubble in a YOLO label file
+    """
+    flags, boxes = [], []
+    if os.path.exists(label_path):
+        with open(label_path, 'r') as label_file:
+            for line in label_file:
+                fields = line.split()
+                if len(fields) < 5 or not fields[0].isdigit():
+                    continue
+                flags.append(int(names[int(fields[0])] == 'shade'))
+                boxes.append([float(value) for value in fields[1:5]])
+    return np.array(flags, dtype=np.int64), np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    IoU of every xyxy box in boxes_a with every one in boxes_b
+    """
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (boxes_a[:, 2:] - boxes_a[:, :2]).prod(axis=1)
+    area_b = (boxes_b[:, 2:] - boxes_b[:, :2]).prod(axis=1)
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+
+
+def update_confusion_matrix(matrix, result, label_flags, label_boxes, iou_threshold=iou_threshold):
+    """
+    Match predictions to labelled bubbles, most confident first, and count every pair in matrix
+    """
+    height, width = result.orig_shape
+    centers, sizes = label_boxes[:, :2], label_boxes[:, 2:]
+    label_xyxy = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1) * [width, height, width, height]
+
+    predicted_boxes = result.boxes.xyxy.cpu().numpy()
+    predicted_flags = np.array([int(result.names[class_id] == 'shade') for class_id in result.boxes.cls.int().tolist()],
+                               dtype=np.int64)
+    order = np.argsort(-result.boxes.conf.cpu().numpy())
+
+    background = len(CONFUSION_LABELS) - 1
+    matched = np.zeros(len(label_flags), dtype=bool)
+    ious = box_iou(predicted_boxes, label_xyxy) if len(predicted_boxes) and len(label_xyxy) else None
+    for prediction in order:
+        label = -1
+        if ious is not None:
+            candidates = np.where(matched, -1.0, ious[prediction])
+            if candidates.max() >= iou_threshold:
+                label = int(candidates.argmax())
+        if label < 0:
+            matrix[background, predicted_flags[prediction]] += 1
+            continue
+        matched[label] = True
+        matrix[label_flags[label], predicted_flags[prediction]] += 1
+    for label_flag in label_flags[~matched]:
+        matrix[label_flag, background] += 1
+
+
+def classification_metrics(matrix):
+    """
+    Accuracy over every labelled or predicted bubble, precision and recall of both classes
+    """
+    total = matrix.sum() - matrix[-1, -1]
+    metrics = {"accuracy": float(np.trace(matrix[:2, :2]) / total) if total else 0.0}
+    for flag, name in enumerate(CONFUSION_LABELS[:2]):
+        predicted, labelled = matrix[:, flag].sum(), matrix[flag, :].sum()
+        metrics[f"{name}_precision"] = float(matrix[flag, flag] / predicted) if predicted else 0.0
+        metrics[f"{name}_recall"] = float(matrix[flag, flag] / labelled) if labelled else 0.0
+    return metrics
+
+
+def evaluate_model(weights_path, image_paths, labels_folder, names, batch=batch_size):
+    """
+    Batched inference over the images for accuracy and throughput, then single image calls for latency
+    """
+    model = YOLO(weights_path, task="detect")
+    matrix = np.zeros((len(CONFUSION_LABELS), len(CONFUSION_LABELS)), dtype=np.int64)
+    # Predictor setup and first-call allocations are not part of the throughput
+    model.predict(source=image_paths[:1], save=False, verbose=False, device=device)
+    inference_seconds = 0.0
+    for start in range(0, len(image_paths), batch):
+        batch_paths = image_paths[start:start + batch]
+        started = time.perf_counter()
+        results = model.predict(source=batch_paths, save=False, verbose=False, device=device)
+        inference_seconds += time.perf_counter() - started
+        for image_path, result in zip(batch_paths, results):
+            label_name = os.path.splitext(os.path.basename(image_path))[0] + ".txt"
+            update_confusion_matrix(matrix, result, *read_label_boxes(os.path.join(labels_folder, label_name), names))
+
+    latency = measure_latency(model, image_paths[:latency_images], device=device)
+    return {
+        "weights": weights_path,
+        "images": len(image_paths),
+        **classification_metrics(matrix),
+        "confusion_matrix": {"labels": list(CONFUSION_LABELS), "matrix": matrix.tolist()},
+        "throughput_images_per_second": len(image_paths) / inference_seconds if inference_seconds else 0.0,
+        "batch_size": batch,
+        "latency": latency,
+    }
+
+
+def promotion_decision(candidate, baseline, tolerance=latency_tolerance, percentile=latency_percentile,
+                       minimum=min_accuracy, without_baseline=promote_without_baseline):
+    """
+    Promote only when the candidate reaches the accuracy floor, is more accurate than the baseline
+    and is not slower than the tolerance allows
+    """
+    if candidate["accuracy"] < minimum:
+        return False, f"accuracy {candidate['accuracy']:.4f} is below the minimum {minimum:.4f}"
+    if baseline is None:
+        if without_baseline:
+            return True, "no baseline to compare with, promote_without_baseline is set"
+        return False, "no baseline to compare with"
+    if candidate["accuracy"] <= baseline["accuracy"]:
+        return False, f"accuracy {candidate['accuracy']:.4f} does not beat {baseline['accuracy']:.4f}"
+    latency_limit = baseline["latency"][percentile] * (1 + tolerance)
+    if candidate["latency"][percentile] > latency_limit:
+        return False, (f"{percentile} {candidate['latency'][percentile]:.1f} ms is over "
+                       f"{latency_limit:.1f} ms ({tolerance:.0%} over the baseline)")
+    return True, (f"accuracy {candidate['accuracy']:.4f} beats {baseline['accuracy']:.4f}, "
+                  f"{percentile} {candidate['latency'][percentile]:.1f} ms within {latency_limit:.1f} ms")
+
+
+def model_evaluate():
+    current_folder = os.getcwd()
+    weights_path = os.path.join(current_folder, artifact_path, "weights", "best.pt")
+    image_paths = split_images("test")
+    if not image_paths:
+        raise ValueError("No test images to evaluate on, run the split step first")
+    with open(os.path.join(current_folder, 'datasets', 'data.yaml'), 'r') as yaml_file:
+        names = yaml.safe_load(yaml_file)["names"]
+    labels_folder = os.path.join(current_folder, 'datasets_temp', 'labels')
+
+    # The model being served is the one to beat, shade_v6.pt until something else was promoted
+    serving_path = promoted_weights() or os.path.join(current_folder, baseline_weights)
+    report = {"candidate": evaluate_model(weights_path, image_paths, labels_folder, names), "baseline": None}
+    if os.path.isfile(serving_path):
+        report["baseline"] = evaluate_model(serving_path, image_paths, labels_folder, names)
+    else:
+        logging.warning(f"No baseline weights at {serving_path}")
+
+    promoted, reason = promotion_decision(report["candidate"], report["baseline"])
+    report["promotion"] = {"promoted": promoted, "reason": reason, "latency_tolerance": latency_tolerance,
+                           "latency_percentile": latency_percentile, "min_accuracy": min_accuracy}
+    if promoted:
+        report["promotion"]["weights"] = promote_weights(weights_path, report)
+
+    report_path = os.path.join(current_folder, artifact_path, REPORT_FILE_NAME)
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    candidate = report["candidate"]
+    print(f"Test accuracy {candidate['accuracy']:.4f}, {candidate['throughput_images_per_second']:.1f} images/s, "
+          f"p50 {candidate['latency']['p50_ms']:.1f} ms, p95 {candidate['latency']['p95_ms']:.1f} ms")
+    print(f"{'Promoted' if promoted else 'Not promoted'}: {reason}")
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import logging
+import configparser
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+from steps.data_split import split_images
+from serving.postprocess import shade_flag
+
+confp = configparser.RawConfigParser()
+confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
+image_size = confp.getint("train", "image_size", fallback=640)
+artifact_path = confp.get("mlflow", "artifact_path", fallback="runs/pipeline/train")
+# Comma separated ultralytics export formats, e.g. "onnx" or "onnx, openvino"
+export_formats = [f.strip() for f in confp.get("export", "formats", fallback="onnx").split(",") if f.strip()]
+parity_batch_size = confp.getint("export", "parity_batch_size", fallback=16)
+
+
+def measure_latency(model, image_paths, device=None):
+    """
+    Per image latency in milliseconds, one image per call as the serving path sees it
+    """
+    latencies = []
+    for image_path in image_paths:
+        start = time.perf_counter()
+        model.predict(source=image_path, save=False, verbose=False, device=device)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.array(latencies)
+    return {
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "images_per_second": float(1000 / latencies.mean()),
+    }
+
+
+def check_parity(reference_model, exported_model, image_paths, batch_size=parity_batch_size):
+    """
+    Compare shade / no shade decisions of the exported model with the PyTorch model
+    """
+    mismatches = []
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        reference_flags = [shade_flag(result) for result in reference_model.predict(source=batch, save=False, verbose=False)]
+        exported_flags = [shade_flag(result) for result in exported_model.predict(source=batch, save=False, verbose=False)]
+        for image_path, reference_flag, exported_flag in zip(batch, reference_flags, exported_flags):
+            if reference_flag != exported_flag:
+                mismatches.append({"image": os.path.basename(image_path),
+                                   "pytorch": reference_flag, "exported": exported_flag})
+    return {
+        "images": len(image_paths),
+        "mismatches": len(mismatches),
+        "agreement": 1.0 - len(mismatches) / max(len(image_paths), 1),
+        "mismatched_images": mismatches,
+    }
+
+
+def export_model(weights_path, formats=export_formats, imgsz=image_size):
+    """
+    Export the weights to each format, returns the exported model path per format
+    """
+    exported_paths = {}
+    for export_format in formats:
+        # Dynamic axes keep batched inference working on the exported model
+        exported_paths[export_format] = YOLO(weights_path).export(format=export_format, imgsz=imgsz, dynamic=True)
+        logging.info(f"Exported {weights_path} to {exported_paths[export_format]}")
+    return exported_paths
+
+
+def write_report(report, report_path):
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"Export report written to {report_path}")
+
+
+def model_export():
+    current_folder = os.getcwd()
+    weights_path = os.path.join(current_folder, artifact_path, "weights", "best.pt")
+    exported_paths = export_model(weights_path)
+
+    report_path = os.path.join(current_folder, artifact_path, "export_report.json")
+    report = {"weights": weights_path, "exported": exported_paths}
+    image_paths = split_images("test")
+    if not image_paths:
+        # Still written, it is the step's output and later steps read it
+        logging.warning("No test images, skipping the parity check and latency comparison")
+        report.update({"test_images": 0, "parity": None, "latency": None, "skipped": "no test images"})
+        write_report(report, report_path)
+        return
+
+    reference_model = YOLO(weights_path)
+    report.update({
+        "test_images": len(image_paths),
+        "latency": {"pytorch": measure_latency(reference_model, image_paths)},
+        "parity": {},
+    })
+    for export_format, exported_path in exported_paths.items():
+        exported_model = YOLO(exported_path, task="detect")
+        report["parity"][export_format] = check_parity(reference_model, exported_model, image_paths)
+        report["latency"][export_format] = measure_latency(exported_model, image_paths)
+        logging.info(f"{export_format}: agreement {report['parity'][export_format]['agreement']:.4f}, "
+                     f"p50 {report['latency'][export_format]['p50_ms']:.1f} ms "
+                     f"(pytorch {report['latency']['pytorch']['p50_ms']:.1f} ms)")
+    write_report(report, report_path)
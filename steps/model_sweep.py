@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import random
+import logging
+import itertools
+import statistics
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+import mlflow
+from mlflow.entities import Metric, Param
+from mlflow.tracking import MlflowClient
+from mlflow.utils.mlflow_tags import MLFLOW_PARENT_RUN_ID
+
+from steps.model_track import create_mlflow_experiment, metric_key
+
+SWEEP_FOLDER = os.path.join("runs", "sweep")
+EXPERIMENT_NAME = "omr"
+DEFAULT_OBJECTIVE = "metrics/mAP50-95(B)"
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+def load_search_space(space_path):
+    """
+    Read a sweep file, see sweep.yaml. Keys of "space" are ultralytics train arguments
+    (imgsz, epochs, lr0, mosaic, fliplr, ...) plus "model", each with a list of values.
+    """
+    with open(space_path, 'r') as space_file:
+        sweep = yaml.safe_load(space_file)
+    sweep.setdefault("objective", DEFAULT_OBJECTIVE)
+    sweep.setdefault("threads_per_trial", 2)
+    sweep.setdefault("seed", 0)
+    sweep.setdefault("early_stop", {})
+    sweep["early_stop"].setdefault("warmup_epochs", 3)
+    sweep["early_stop"].setdefault("min_trials", 2)
+    return sweep
+
+
+def sample_trials(space, trials=None, seed=0):
+    """
+    Every combination of the space, or a reproducible random sample of trials of them
+    """
+    names = sorted(space)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if trials is not None and trials < len(combinations):
+        combinations = random.Random(seed).sample(combinations, trials)
+    return combinations
+
+
+class MedianStopper:
+    """
+    Stop a trial whose objective at an epoch is below the median other trials reached at that
+    epoch. Reports are shared between the trial processes through a manager dict.
+    """
+    def __init__(self, reports, lock, warmup_epochs=3, min_trials=2):
+        self.reports = reports
+        self.lock = lock
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+
+    def report(self, trial_number, epoch, value) -> bool:
+        """
+        Record the trial's value at epoch, returns True when the trial should stop
+        """
+        with self.lock:
+            epoch_reports = self.reports.get(epoch, {})
+            others = list(epoch_reports.values())
+            epoch_reports[trial_number] = value
+            self.reports[epoch] = epoch_reports
+        if epoch < self.warmup_epochs or len(others) < self.min_trials:
+            return False
+        return value < statistics.median(others)
+
+
+@contextmanager
+def _thread_limit_env(threads):
+    """
+    Thread limits for the spawned trial processes. They have to be in the environment the
+    processes start with, re-importing the main module there imports torch before any
+    initializer could set them. The sweep process's own environment is restored afterwards.
+    """
+    previous = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: str(threads) for name in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_trial(trial_number, trial, settings, stopper):
+    """
+    Train one configuration in a pool process, logged as a run nested under the sweep run
+    """
+    import torch
+    from ultralytics import YOLO
+    from steps.model_train import CachedDetectionTrainer
+    torch.set_num_threads(settings["threads_per_trial"])
+
+    client = MlflowClient()
+    run_id = client.create_run(settings["experiment_id"], run_name=f"trial_{trial_number}",
+                               tags={MLFLOW_PARENT_RUN_ID: settings["parent_run_id"]}).info.run_id
+    client.log_batch(run_id, params=[Param(name, str(value)) for name, value in sorted(trial.items())])
+
+    train_args = dict(trial)
+    model_name = os.path.splitext(train_args.pop("model", "yolov8n"))[0]
+    model = YOLO(model_name + ".yaml").load(model_name + ".pt")
+    history = []
+    stopped_at = None
+
+    def on_fit_epoch_end(trainer):
+        nonlocal stopped_at
+        epoch = trainer.epoch + 1
+        if epoch <= len(history):
+            # The final validation of best.pt fires this again for the last epoch
+            return
+        timestamp = int(time.time() * 1000)
+        client.log_batch(run_id, metrics=[Metric(metric_key(name), float(value), timestamp, epoch)
+                                          for name, value in trainer.metrics.items()])
+        value = float(trainer.metrics.get(settings["objective"], 0.0))
+        history.append(value)
+        # Stopping at the last epoch would end nothing early
+        if stopper.report(trial_number, epoch, value) and epoch < trainer.epochs:
+            logging.info(f"Trial {trial_number} stopped early at epoch {epoch}, {settings['objective']} {value:.4f}")
+            stopped_at = epoch
+            trainer.stop = True
+
+    model.add_callback("on_fit_epoch_end", on_fit_epoch_end)
+    result = {"trial": trial_number, "params": trial, "run_id": run_id}
+    # With the trial run active, ultralytics' own MLflow logging (when enabled) goes into it too
+    os.environ["MLFLOW_EXPERIMENT_NAME"] = settings["experiment_name"]
+    os.environ["MLFLOW_KEEP_RUN_ACTIVE"] = "True"
+    try:
+        with mlflow.start_run(run_id=run_id):
+            model.train(data=settings["data"], project=settings["project"], name=f"trial_{trial_number}",
+                        exist_ok=True, workers=settings["threads_per_trial"], trainer=CachedDetectionTrainer,
+                        verbose=False, **train_args)
+    except Exception as e:
+        logging.exception(f"Trial {trial_number} failed")
+        client.set_tag(run_id, "trial_status", "failed")
+        return {**result, "status": "failed", "error": str(e)}
+
+    # Set by the stopper rather than read from epoch counts, epochs may not be in the space
+    status = "stopped" if stopped_at is not None else "completed"
+    best = max(history) if history else None
+    client.set_tag(run_id, "trial_status", status)
+    if best is not None:
+        client.log_metric(run_id, "best_objective", best)
+    return {**result, "status": status, "epochs": len(history), "best_objective": best,
+            "weights": os.path.join(settings["project"], f"trial_{trial_number}", "weights", "best.pt")}
+
+
+def model_sweep(space_path):
+    """
+    Train every trial of a search space in parallel and log them as nested runs of one sweep run
+    """
+    from serving.workers import available_cores
+    from steps.image_cache import build_image_cache, cache_folder_for, cache_is_current
+    from steps.data_split import SPLITS, split_images
+
+    sweep = load_search_space(space_path)
+    trials = sample_trials(sweep["space"], sweep.get("trials"), sweep["seed"])
+    threads_per_trial = sweep["threads_per_trial"]
+    workers = sweep.get("parallel_trials") or max(1, available_cores() // threads_per_trial)
+
+    # Every image size in the space gets its cache up front, using all the cores once.
+    # A cache built from other image files, e.g. before a re-download, is rebuilt.
+    image_paths = [image_path for split in SPLITS for image_path in split_images(split)]
+    for size in sorted({trial.get("imgsz", 640) for trial in trials}):
+        if not cache_is_current(image_paths, cache_folder_for(size), size):
+            build_image_cache(image_paths, cache_folder_for(size), size)
+
+    experiment_id = create_mlflow_experiment(experiment_name=EXPERIMENT_NAME, artifact_location="omr_artifacts",
+                                             tags={"env": "dev", "version": "1.0.0"})
+    sweep_name = f"sweep_{time.strftime('%Y%m%d_%H%M%S')}"
+    with mlflow.start_run(run_name=sweep_name, experiment_id=experiment_id) as parent_run:
+        mlflow.log_params({"trials": len(trials), "parallel_trials": workers,
+                           "threads_per_trial": threads_per_trial, "objective": sweep["objective"]})
+        mlflow.log_dict(sweep, "sweep.yaml")
+        settings = {
+            "experiment_id": experiment_id,
+            "experiment_name": EXPERIMENT_NAME,
+            "parent_run_id": parent_run.info.run_id,
+            "data": os.path.join(os.getcwd(), "datasets", "data.yaml"),
+            "project": os.path.join(os.getcwd(), SWEEP_FOLDER, sweep_name),
+            "objective": sweep["objective"],
+            "threads_per_trial": threads_per_trial,
+        }
+        logging.info(f"Running {len(trials)} trials, {workers} at a time with {threads_per_trial} threads each")
+
+        # spawn, so no trial inherits torch thread pools from this process
+        context = multiprocessing.get_context("spawn")
+        with context.Manager() as manager:
+            stopper = MedianStopper(manager.dict(), manager.Lock(), sweep["early_stop"]["warmup_epochs"],
+                                    sweep["early_stop"]["min_trials"])
+            with _thread_limit_env(threads_per_trial), \
+                    ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [executor.submit(run_trial, number, trial, settings, stopper)
+                           for number, trial in enumerate(trials)]
+                results = [future.result() for future in futures]
+
+        scored = [result for result in results if result.get("best_objective") is not None]
+        if scored:
+            best = max(scored, key=lambda result: result["best_objective"])
+            mlflow.log_metric("best_objective", best["best_objective"])
+            mlflow.set_tags({"best_trial": best["trial"], "best_run_id": best["run_id"]})
+            mlflow.log_params({f"best_{name}": value for name, value in best["params"].items()})
+        mlflow.log_dict(results, "trials.json")
+
+    os.makedirs(settings["project"], exist_ok=True)
+    with open(os.path.join(settings["project"], "trials.json"), 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Sweep {sweep_name}: {sum(r['status'] == 'completed' for r in results)} completed, "
+          f"{sum(r['status'] == 'stopped' for r in results)} stopped early, "
+          f"{sum(r['status'] == 'failed' for r in results)} failed")
+    return results
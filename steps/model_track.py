@@ -1,18 +1,30 @@
 import mlflow
+from mlflow.entities import Metric
+from mlflow.tracking import MlflowClient
 from typing import Any
 import os
 from pathlib import Path
 import configparser
 import logging
 import os
+import re
 import csv
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 confp = configparser.RawConfigParser()
 confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
 num_of_epochs = confp.get("train","num_of_epochs")
 image_size = confp.get("train","image_size")
-artifact_path = confp.get("mlflow", "artifact_path")
+artifact_path = confp.get("mlflow", "artifact_path", fallback="runs/pipeline/train")
 model_name = confp.get("train", "model")
+upload_workers = confp.getint("mlflow", "upload_workers", fallback=8)
+
+METRICS_PER_BATCH = 1000
+WEIGHTS_FILE_NAMES = ("best.pt", "last.pt")
+EVALUATION_REPORT_FILE_NAME = "evaluation_report.json"
 
 def create_mlflow_experiment(experiment_name: str, artifact_location: str, tags:dict[str,Any]) -> str:
     """
@@ -54,89 +66,139 @@ def get_mlflow_experiment(experiment_id:str=None, experiment_name:str=None) -> m
         raise ValueError("Either experiment_id or experiment_name must be provided.")
     return experiment
 
-def get_metrics():
-    current_path = os.getcwd()
-    #train_output_path = "runs/detect/train/results.csv"
+def metric_key(column: str) -> str:
+    """
+    MLflow key for a results.csv column, e.g. metrics/mAP50-95(B) -> metrics_mAP50_95_B
+    """
+    return re.sub(r"\W+", "_", column).strip("_")
 
-    last_row = None
-    csv_file_path = os.path.join(current_path, 'runs', 'detect', 'train', 'results.csv')
+
+def get_metrics(csv_file_path):
+    """
+    Every epoch of results.csv as MLflow metrics, keyed by the CSV header and stepped by epoch
+    """
+    timestamp = int(time.time() * 1000)
+    metrics = []
     with open(csv_file_path, 'r') as file:
         csv_reader = csv.reader(file)
+        header = [column.strip() for column in next(csv_reader)]
+        epoch_column = header.index("epoch")
         for row in csv_reader:
-            last_row = row
-
-    train_box_loss = float(last_row[1].replace(" ",""))
-    train_cls_loss = float(last_row[2].replace(" ", ""))
-    train_dfl_loss = float(last_row[3].replace(" ", ""))
-    metrics_precision_B = float(last_row[4].replace(" ", ""))
-    metrics_recall_B = float(last_row[5].replace(" ", ""))
-    metrics_mAP50_B = float(last_row[6].replace(" ", ""))
-    metrics_mAP50_95_B = float(last_row[7].replace(" ", ""))
-    val_box_loss = float(last_row[8].replace(" ", ""))
-    val_cls_loss = float(last_row[9].replace(" ", ""))
-    val_dfl_loss = float(last_row[10].replace(" ", ""))
-    lr_pg0 = float(last_row[11].replace(" ", ""))
-    lr_pg1 = float(last_row[12].replace(" ", ""))
-    lr_pg2 = float(last_row[13].replace(" ", ""))
-    
-    metrics = {
-    "train_box_loss": train_box_loss,
-    "train_cls_loss": train_cls_loss,
-    "train_dfl_loss": train_dfl_loss,
-    "metrics_precision_B" : metrics_precision_B,
-    "metrics_recall_B" : metrics_recall_B,
-    "metrics_mAP50_B" : metrics_mAP50_B,
-    "metrics_mAP50_95_B" : metrics_mAP50_95_B,
-    "val_box_loss" : val_box_loss,
-    "val_cls_loss" : val_cls_loss,
-    "val_dfl_loss" : val_dfl_loss,
-    "lr_pg0" : lr_pg0,
-    "lr_pg1" : lr_pg1,
-    "lr_pg2" : lr_pg2,
-    }
-
+            if not row:
+                continue
+            values = [value.strip() for value in row]
+            step = int(float(values[epoch_column]))
+            for column, value in zip(header, values):
+                if column == "epoch" or not value:
+                    continue
+                metrics.append(Metric(key=metric_key(column), value=float(value), timestamp=timestamp, step=step))
     return metrics
 
+
+def get_evaluation_metrics(report_path):
+    """
+    Test split numbers of the trained model from the evaluation report, prefixed with test_
+    """
+    if not os.path.exists(report_path):
+        return []
+    with open(report_path, 'r') as report_file:
+        report = json.load(report_file)
+    candidate = report["candidate"]
+    values = {name: value for name, value in candidate.items() if name.endswith(("accuracy", "precision", "recall"))}
+    values["throughput_images_per_second"] = candidate["throughput_images_per_second"]
+    values.update({f"latency_{name}": value for name, value in candidate["latency"].items()})
+    values["promoted"] = float(report["promotion"]["promoted"])
+    timestamp = int(time.time() * 1000)
+    return [Metric(key=f"test_{name}", value=float(value), timestamp=timestamp, step=0)
+            for name, value in values.items()]
+
+
+def log_metrics(client, run_id, metrics):
+    # log_batch takes at most METRICS_PER_BATCH metrics per call
+    for start in range(0, len(metrics), METRICS_PER_BATCH):
+        client.log_batch(run_id, metrics=metrics[start:start + METRICS_PER_BATCH])
+
+
 def get_artifacts(artifact_path):
-    current_path = os.getcwd()
-    complete_artifact_path = os.path.join(current_path, artifact_path)
-    file_names = [
-                  "args.yaml", 
-                  "confusion_matrix_normalized.png", 
-                  "confusion_matrix.png", 
-                  "F1_curve.png", 
-                  "labels_correlogram.jpg", 
-                  "labels.jpg", 
-                  "P_curve.png", 
-                  "PR_curve.png", 
-                  "R_curve.png", 
-                  "results.csv",
-                  "results.png",
-                  "train_batch0.jpg",
-                  "train_batch1.jpg",
-                  "train_batch2.jpg",
-                  "val_batch0_labels.jpg",
-                  "val_batch0_pred.jpg"
-                  ]
-
-    for file_name in file_names:
-        file_path = os.path.join(complete_artifact_path, file_name)
-        mlflow.log_artifact(local_path=file_path)
-
-    best_weights_path = os.path.join(complete_artifact_path, "weights", "best.pt")
-    last_weights_path = os.path.join(complete_artifact_path, "weights", "last.pt")
-    mlflow.log_artifact(local_path=best_weights_path, artifact_path="weights")
-    mlflow.log_artifact(local_path=last_weights_path, artifact_path="weights")
+    """
+    Every file the training run wrote next to its weights, as (local path, artifact folder) pairs
+    """
+    complete_artifact_path = os.path.join(os.getcwd(), artifact_path)
+    return [
+        (os.path.join(complete_artifact_path, file_name), None)
+        for file_name in sorted(os.listdir(complete_artifact_path))
+        if os.path.isfile(os.path.join(complete_artifact_path, file_name))
+    ]
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as weights_file:
+        for chunk in iter(lambda: weights_file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def find_logged_weights(client, experiment_id, sha256):
+    """
+    Artifact uri of weights with this content already logged in the experiment, None if there are none.
+    Only finished runs count and the artifact has to still be there.
+    """
+    for weights_name in WEIGHTS_FILE_NAMES:
+        tag = f"weights_sha256_{os.path.splitext(weights_name)[0]}"
+        filter_string = f"tags.{tag} = '{sha256}' and attributes.status = 'FINISHED'"
+        for run in client.search_runs([experiment_id], filter_string=filter_string):
+            artifact = f"weights/{weights_name}"
+            if any(file_info.path == artifact for file_info in client.list_artifacts(run.info.run_id, "weights")):
+                return f"{run.info.artifact_uri}/{artifact}"
+    return None
+
+
+def get_weights(client, experiment_id, run_id, artifact_path):
+    """
+    Weights to upload, skipping files byte-identical to weights already logged in the experiment.
+    Returns the uploads and the hash tags to set on the run once they are uploaded,
+    a skipped file is tagged with where its copy lives.
+    """
+    weights_folder = os.path.join(os.getcwd(), artifact_path, "weights")
+    uploads = []
+    hash_tags = {}
+    uploaded = {}
+    for weights_name in WEIGHTS_FILE_NAMES:
+        weights_path = os.path.join(weights_folder, weights_name)
+        if not os.path.isfile(weights_path):
+            continue
+        sha256 = file_sha256(weights_path)
+        stem = os.path.splitext(weights_name)[0]
+        logged_uri = uploaded.get(sha256) or find_logged_weights(client, experiment_id, sha256)
+        if logged_uri is not None:
+            logging.info(f"{weights_name} is identical to {logged_uri}, not uploaded")
+            client.set_tag(run_id, f"weights_logged_{stem}", logged_uri)
+        else:
+            uploads.append((weights_path, "weights"))
+            uploaded[sha256] = f"{client.get_run(run_id).info.artifact_uri}/weights/{weights_name}"
+            hash_tags[f"weights_sha256_{stem}"] = sha256
+    return uploads, hash_tags
+
 
 def get_data_analysis():
     current_path = os.getcwd()
-    data_test_path = os.path.join(current_path, "data_test_analysis.png")
-    data_train_path = os.path.join(current_path, "data_train_analysis.png")
-    data_valid_path = os.path.join(current_path, "data_valid_analysis.png")
+    return [
+        (os.path.join(current_path, f"data_{split}_analysis.png"), "datasets_analysis")
+        for split in ("test", "train", "valid")
+    ]
+
+
+def upload_artifacts(client, run_id, uploads, workers=upload_workers):
+    """
+    Upload (local path, artifact folder) pairs concurrently
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(client.log_artifact, run_id, local_path, artifact_folder)
+                   for local_path, artifact_folder in uploads]
+        for future in futures:
+            future.result()
 
-    mlflow.log_artifact(local_path=data_test_path, artifact_path="datasets_analysis")
-    mlflow.log_artifact(local_path=data_train_path, artifact_path="datasets_analysis")
-    mlflow.log_artifact(local_path=data_valid_path, artifact_path="datasets_analysis")
 
 def model_track():
     experiment_id = create_mlflow_experiment(
@@ -155,12 +217,18 @@ def model_track():
         mlflow.log_params(parameters)
         logging.info("Parameters logged.")
 
-        metrics = get_metrics()
-        mlflow.log_metrics(metrics)
-        logging.info("Metrics logged.")
-
-        get_artifacts(artifact_path)
-        logging.info("Artifacts logged.")
-        #get_data_analysis()
-        logging.info("Data analysis logged.")
-        logging.info("run_id: {}".format(run.info.run_id))
+        client = MlflowClient()
+        run_id = run.info.run_id
+        metrics = (get_metrics(os.path.join(os.getcwd(), artifact_path, "results.csv"))
+                   + get_evaluation_metrics(os.path.join(os.getcwd(), artifact_path, EVALUATION_REPORT_FILE_NAME)))
+        log_metrics(client, run_id, metrics)
+        logging.info(f"{len(metrics)} metric values logged.")
+
+        weights_uploads, hash_tags = get_weights(client, experiment.experiment_id, run_id, artifact_path)
+        uploads = get_artifacts(artifact_path) + weights_uploads + get_data_analysis()
+        upload_artifacts(client, run_id, uploads)
+        # Tagged only once the weights are uploaded, later runs reuse them through these tags
+        for tag, sha256 in hash_tags.items():
+            client.set_tag(run_id, tag, sha256)
+        logging.info(f"{len(uploads)} artifacts logged.")
+        logging.info("run_id: {}".format(run_id))
@@ -2,22 +2,119 @@ import logging
 import configparser
 from pathlib import Path
 from ultralytics import YOLO
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import unwrap_model
 import os
+import json
+import time
+import resource
 
-def model_train():
+from steps.data_split import SPLITS, split_images
+from steps.image_cache import CachedYOLODataset, ImageCache, cache_folder_for, cache_is_current
+
+confp = configparser.RawConfigParser()
+confp.read(os.path.abspath(os.path.join(Path(__file__).absolute(), os.pardir)) + '/config.ini')
+# Untracked, runs/detect/train holds the committed baseline artifacts
+artifact_path = confp.get("mlflow", "artifact_path", fallback="runs/pipeline/train")
+num_of_epochs = confp.getint("train", "num_of_epochs", fallback=2)
+image_size = confp.getint("train", "image_size", fallback=640)
+model_name = os.path.splitext(confp.get("train", "model", fallback="yolov8n"))[0]
+# Train from the pre-decoded shards written by steps/image_cache instead of the JPEGs
+use_image_cache = confp.getboolean("train", "image_cache", fallback=True)
+
+PROFILE_FILE_NAME = "train_profile.json"
+
+
+class CachedDetectionTrainer(DetectionTrainer):
+    """
+    DetectionTrainer whose datasets read images from the image cache at the training image size
+    """
+    def build_dataset(self, img_path, mode="train", batch=None):
+        cache_folder = cache_folder_for(self.args.imgsz)
+        # The cache matches images by file name, one built from other files would train on old pixels
+        image_paths = [image_path for split in SPLITS for image_path in split_images(split)]
+        if not cache_is_current(image_paths, cache_folder, self.args.imgsz):
+            logging.warning(f"No image cache of the current images at {cache_folder}, "
+                            f"decoding the images every epoch, run the image_cache step to rebuild it")
+            return super().build_dataset(img_path, mode, batch)
+
+        # Same arguments build_yolo_dataset passes for detection, with the cache added
+        return CachedYOLODataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=max(int(unwrap_model(self.model).stride.max()), 32),
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode}: "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0,
+            image_cache=ImageCache(cache_folder),
+        )
+
+
+class TrainProfiler:
+    """
+    Training callbacks recording the wall time of every epoch, reported with the peak RAM
+    """
+    def __init__(self):
+        self.epoch_seconds = []
+        self.fit_epoch_seconds = []
+        self._epoch_started = None
+
+    def on_train_epoch_start(self, trainer):
+        self._epoch_started = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer):
+        self.epoch_seconds.append(time.perf_counter() - self._epoch_started)
+
+    def on_fit_epoch_end(self, trainer):
+        # Includes validation, the final validation of best.pt fires this again and is left out
+        if len(self.fit_epoch_seconds) < len(self.epoch_seconds):
+            self.fit_epoch_seconds.append(time.perf_counter() - self._epoch_started)
+
+    def report(self, image_cache):
+        # ru_maxrss is in kilobytes on Linux, children covers the dataloader workers that have exited
+        return {
+            "image_cache": image_cache,
+            "epochs": len(self.epoch_seconds),
+            "epoch_seconds": self.epoch_seconds,
+            "fit_epoch_seconds": self.fit_epoch_seconds,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_children_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+
+
+def model_train(image_cache=use_image_cache):
     current_folder = os.getcwd()
     yaml_local_path = os.path.join(current_folder, 'datasets', 'data.yaml')
-    num_of_epochs = 2
-    image_size = 640
-    model_name = 'yolov8n'
 
     # Load a model
     yaml_model_name = model_name + ".yaml"
     pt_model_name = model_name + ".pt"
-    model = YOLO(yaml_model_name)  # build a new model from YAML
-    model = YOLO(pt_model_name)  # load a pretrained model (recommended for training)
     model = YOLO(yaml_model_name).load(pt_model_name)  # build from YAML and transfer weights
 
+    profiler = TrainProfiler()
+    for event in ("on_train_epoch_start", "on_train_epoch_end", "on_fit_epoch_end"):
+        model.add_callback(event, getattr(profiler, event))
+
     # Train the model
-    results = model.train(data=yaml_local_path, epochs=num_of_epochs, imgsz=image_size)
-    print(f"Finish train model {pt_model_name}")
+    # Always written to artifact_path, where export and tracking read it, instead of a new trainN folder
+    train_folder = os.path.join(current_folder, artifact_path)
+    results = model.train(data=yaml_local_path, epochs=num_of_epochs, imgsz=image_size,
+                          project=os.path.dirname(train_folder), name=os.path.basename(train_folder), exist_ok=True,
+                          trainer=CachedDetectionTrainer if image_cache else None)
+
+    report = profiler.report(image_cache)
+    with open(os.path.join(train_folder, PROFILE_FILE_NAME), 'w') as profile_file:
+        json.dump(report, profile_file, indent=2)
+    epoch_seconds = sum(report["epoch_seconds"]) / max(report["epochs"], 1)
+    print(f"Finish train model {pt_model_name}: {epoch_seconds:.1f}s per epoch, "
+          f"peak RAM {report['peak_rss_mb']:.0f} MB (image cache {'on' if image_cache else 'off'})")
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+from serving.batching import InferenceBatcher
+
+
+class RecordingModel:
+    """
+    predict_fn that records the size of every batch, gate holds calls until it is set
+    """
+    def __init__(self, gate=None):
+        self.batches = []
+        self.gate = gate
+
+    def __call__(self, images):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batches.append(len(images))
+        return [image * 2 for image in images]
+
+
+def test_full_batch_is_dispatched_without_waiting():
+    model = RecordingModel()
+    batcher = InferenceBatcher(model, max_batch_size=4, max_wait_ms=10_000)
+    started = time.monotonic()
+    futures = batcher.submit_many(range(4))
+    assert [future.result(timeout=5) for future in futures] == [0, 2, 4, 6]
+    assert time.monotonic() - started < 5
+    assert model.batches == [4]
+
+
+def test_partial_batch_is_dispatched_after_max_wait():
+    model = RecordingModel()
+    batcher = InferenceBatcher(model, max_batch_size=8, max_wait_ms=50)
+    started = time.monotonic()
+    futures = batcher.submit_many(range(3))
+    assert [future.result(timeout=5) for future in futures] == [0, 2, 4]
+    assert time.monotonic() - started >= 0.05
+    assert model.batches == [3]
+
+
+def test_queued_images_are_split_into_batches_of_max_size():
+    gate = threading.Event()
+    model = RecordingModel(gate)
+    batcher = InferenceBatcher(model, max_batch_size=3, max_wait_ms=0)
+    first = batcher.submit(0)
+    # The worker holds the first image in the model call while the rest queue up behind it
+    time.sleep(0.1)
+    rest = batcher.submit_many(range(1, 8))
+    gate.set()
+    assert [future.result(timeout=5) for future in [first, *rest]] == [value * 2 for value in range(8)]
+    assert model.batches == [1, 3, 3, 1]
+
+
+def test_model_error_fails_every_image_of_the_batch():
+    def failing(images):
+        raise ValueError("bad batch")
+
+    batcher = InferenceBatcher(failing, max_batch_size=2, max_wait_ms=10_000)
+    for future in batcher.submit_many(range(2)):
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+
+def test_short_result_list_fails_the_unmatched_images():
+    batcher = InferenceBatcher(lambda images: images[:1], max_batch_size=3, max_wait_ms=10_000)
+    first, *rest = batcher.submit_many(["a", "b", "c"])
+    assert first.result(timeout=5) == "a"
+    for future in rest:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+
+
+def test_on_batch_gets_the_queue_wait_of_every_image():
+    waits = []
+    batcher = InferenceBatcher(lambda images: images, max_batch_size=2, max_wait_ms=10_000,
+                               on_batch=waits.append)
+    for future in batcher.submit_many(range(2)):
+        future.result(timeout=5)
+    assert len(waits) == 1 and len(waits[0]) == 2
+    assert all(wait >= 0 for wait in waits[0])
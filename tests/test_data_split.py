@@ -0,0 +1,73 @@
+import json
+import os
+from collections import Counter
+
+from steps.data_split import SPLIT_MANIFEST_FILE_NAME, assign_split, split_dataset
+
+RATIOS = {"train": 0.8, "test": 0.1, "valid": 0.1}
+
+
+def make_dataset(root, names, class_id=0):
+    """
+    Images and YOLO label files under root, every label holds one box of class_id
+    """
+    images_folder, labels_folder = root / "datasets_temp" / "images", root / "datasets_temp" / "labels"
+    images_folder.mkdir(parents=True, exist_ok=True)
+    labels_folder.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        (images_folder / f"{name}.jpg").write_bytes(name.encode())
+        (labels_folder / f"{name}.txt").write_text(f"{class_id} 0.5 0.5 0.1 0.1\n")
+    return str(images_folder), str(labels_folder)
+
+
+def read_manifest(root):
+    with open(root / "datasets" / SPLIT_MANIFEST_FILE_NAME) as manifest_file:
+        return json.load(manifest_file)
+
+
+def test_assign_split_fills_the_split_furthest_behind():
+    counts = Counter()
+    for _ in range(20):
+        counts[assign_split(counts, RATIOS)] += 1
+    assert counts == {"train": 16, "test": 2, "valid": 2}
+
+
+def test_assign_split_catches_up_a_lagging_split():
+    assert assign_split(Counter({"train": 8}), RATIOS) in ("test", "valid")
+    assert assign_split(Counter({"train": 8, "test": 1, "valid": 1}), RATIOS) == "train"
+
+
+def test_every_class_mix_is_split_by_the_ratios(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_dataset(tmp_path, [f"empty_{i}" for i in range(10)], class_id=0)
+    images_folder, labels_folder = make_dataset(tmp_path, [f"shade_{i}" for i in range(10)], class_id=1)
+    split_dataset(images_folder, labels_folder, mode="list")
+    manifest = read_manifest(tmp_path)
+    for stratum in ("0", "1"):
+        counts = Counter(entry["split"] for entry in manifest.values() if entry["stratum"] == stratum)
+        assert counts == {"train": 8, "test": 1, "valid": 1}
+
+
+def test_images_keep_their_split_when_images_are_added_or_removed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    images_folder, labels_folder = make_dataset(tmp_path, [f"image_{i}" for i in range(20)])
+    split_dataset(images_folder, labels_folder, mode="list")
+    before = read_manifest(tmp_path)
+
+    make_dataset(tmp_path, [f"added_{i}" for i in range(10)])
+    os.remove(os.path.join(images_folder, "image_0.jpg"))
+    split_dataset(images_folder, labels_folder, mode="list")
+    after = read_manifest(tmp_path)
+
+    assert "image_0.jpg" not in after
+    assert all(after[file] == before[file] for file in before if file != "image_0.jpg")
+    assert len(after) == 29
+
+
+def test_split_folders_follow_the_manifest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    images_folder, labels_folder = make_dataset(tmp_path, [f"image_{i}" for i in range(10)])
+    split_dataset(images_folder, labels_folder, mode="copy")
+    for file, entry in read_manifest(tmp_path).items():
+        assert (tmp_path / "datasets" / entry["split"] / "images" / file).exists()
+        assert (tmp_path / "datasets" / entry["split"] / "labels" / file.replace(".jpg", ".txt")).exists()
@@ -0,0 +1,96 @@
+import types
+
+import pytest
+
+import serving.model_registry
+import serving.prediction_cache
+from serving.model_registry import ModelRegistry
+from serving.prediction_cache import PredictionCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Replace the cache's monotonic clock with one the test moves forward by hand
+    """
+    clock = types.SimpleNamespace(now=1000.0)
+    clock.monotonic = lambda: clock.now
+    monkeypatch.setattr(serving.prediction_cache, "time", clock)
+    return clock
+
+
+def test_hit_and_miss_are_counted():
+    cache = PredictionCache(max_bytes=100)
+    cache.put("a", "value", size_bytes=10)
+    assert cache.get("a") == "value"
+    assert cache.get("b") is None
+    assert cache.get("a", accept=lambda value: False) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_least_recently_used_entries_are_evicted_past_max_bytes():
+    cache = PredictionCache(max_bytes=100)
+    for key in "abc":
+        cache.put(key, key, size_bytes=40)
+    assert cache.get("a") is None
+    assert cache.stats()["size_bytes"] == 80
+
+    cache.get("b")
+    cache.put("d", "d", size_bytes=40)
+    assert cache.get("c") is None and cache.get("b") == "b"
+    assert cache.stats()["evictions"] == 2
+
+
+def test_replacing_a_key_does_not_count_its_bytes_twice():
+    cache = PredictionCache(max_bytes=100)
+    cache.put("a", "old", size_bytes=60)
+    cache.put("a", "new", size_bytes=30)
+    assert cache.get("a") == "new"
+    assert cache.stats()["size_bytes"] == 30
+
+
+def test_entry_larger_than_the_cache_is_not_stored():
+    cache = PredictionCache(max_bytes=100)
+    cache.put("a", "a", size_bytes=10)
+    cache.put("big", "big", size_bytes=101)
+    assert cache.get("big") is None and cache.get("a") == "a"
+    assert cache.stats()["size_bytes"] == 10
+
+
+def test_expired_entries_miss_and_free_their_bytes(clock):
+    cache = PredictionCache(max_bytes=100, ttl_seconds=60)
+    cache.put("a", "a", size_bytes=10)
+    clock.now += 59
+    assert cache.get("a") == "a"
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.stats()["size_bytes"] == 0 and cache.stats()["entries"] == 0
+
+
+def test_key_depends_on_the_model_version():
+    assert PredictionCache.key(b"image", "v1") != PredictionCache.key(b"image", "v2")
+
+
+class FakeYOLO:
+    def __init__(self, model_path, task=None):
+        self.model_path = model_path
+
+    def predict(self, source, save=False, verbose=False):
+        return [None for _ in source]
+
+
+def test_model_swap_clears_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(serving.model_registry, "YOLO", FakeYOLO)
+    registry = ModelRegistry(warmup_runs=1, warmup_size=8)
+    cache = PredictionCache(max_bytes=100)
+    registry.add_listener(cache.clear)
+
+    weights_path = tmp_path / "best.pt"
+    weights_path.write_bytes(b"first weights")
+    registry.load(str(weights_path), background=False)
+    cache.put(PredictionCache.key(b"image", registry.active().version), "payload", size_bytes=10)
+
+    weights_path.write_bytes(b"second weights")
+    registry.load(str(weights_path), background=False)
+    assert cache.stats()["entries"] == 0 and cache.stats()["size_bytes"] == 0
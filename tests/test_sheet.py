@@ -0,0 +1,62 @@
+import numpy as np
+
+from serving.sheet import assign_grid
+
+
+def make_boxes(blocks=2, options=4, rows=5, skip=()):
+    """
+    Bubble boxes of a sheet laid out in blocks side by side, skip holds (block, option) columns left empty
+    """
+    boxes = []
+    for block in range(blocks):
+        for option in range(options):
+            if (block, option) in skip:
+                continue
+            for row in range(rows):
+                x = 100 + block * 400 + option * 50
+                y = 100 + row * 50
+                boxes.append([x, y, x + 30, y + 30])
+    return np.array(boxes, dtype=np.float32)
+
+
+def expected_cells(blocks=2, options=4, rows=5, skip=()):
+    questions, option_numbers = [], []
+    for block in range(blocks):
+        for option in range(options):
+            if (block, option) in skip:
+                continue
+            for row in range(rows):
+                questions.append(block * rows + row)
+                option_numbers.append(option)
+    return questions, option_numbers
+
+
+def test_full_grid_is_numbered_block_by_block():
+    questions, options, complete = assign_grid(make_boxes(), options_per_question=4)
+    assert (questions.tolist(), options.tolist()) == expected_cells()
+    assert complete
+
+
+def test_empty_column_does_not_shift_later_blocks():
+    skip = {(0, 1)}
+    questions, options, complete = assign_grid(make_boxes(skip=skip), options_per_question=4)
+    assert (questions.tolist(), options.tolist()) == expected_cells(skip=skip)
+    assert not complete
+
+
+def test_empty_first_column_is_flagged():
+    _, _, complete = assign_grid(make_boxes(skip={(1, 0)}), options_per_question=4)
+    assert not complete
+
+
+def test_without_options_per_question_rows_and_columns_are_returned():
+    rows, columns, complete = assign_grid(make_boxes(blocks=1), options_per_question=None)
+    assert sorted(set(rows.tolist())) == list(range(5))
+    assert sorted(set(columns.tolist())) == list(range(4))
+    assert complete
+
+
+def test_no_boxes():
+    questions, options, complete = assign_grid(np.zeros((0, 4), dtype=np.float32), options_per_question=4)
+    assert len(questions) == len(options) == 0
+    assert not complete
@@ -0,0 +1,125 @@
+import importlib.util
+import json
+
+import pytest
+
+from pipelines.step_runner import Step, StepRunner
+
+
+class CountingStep:
+    """
+    Step function writing output_name under folder, counting its calls, raising while fail is set
+    """
+    def __init__(self, folder, output_name):
+        self.output_path = folder / output_name
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("step failed")
+        self.output_path.write_text(str(self.calls))
+
+
+def step_function(counting_step):
+    # The fingerprint reads the source file of the step function, a callable instance has none
+    def run():
+        counting_step()
+    return run
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    (tmp_path / "config.ini").write_text("[first]\nvalue = 1\n[second]\nvalue = 1\n")
+    (tmp_path / "raw.txt").write_text("raw data")
+    first, second = CountingStep(tmp_path, "first.txt"), CountingStep(tmp_path, "second.txt")
+    steps = [
+        Step("first", step_function(first), inputs=("raw.txt",), outputs=("first.txt",), config=("first",)),
+        Step("second", step_function(second), inputs=("first.txt",), outputs=("second.txt",),
+             config=("second.value",)),
+    ]
+    return tmp_path, steps, first, second
+
+
+def make_runner(folder, steps):
+    return StepRunner(steps, str(folder / "config.ini"), working_folder=str(folder),
+                      state_folder=str(folder / "state"))
+
+
+def statuses(records):
+    return [record.status for record in records]
+
+
+def test_unchanged_steps_are_skipped(workspace):
+    folder, steps, first, second = workspace
+    assert statuses(make_runner(folder, steps).run()) == ["succeeded", "succeeded"]
+    assert statuses(make_runner(folder, steps).run()) == ["cached", "cached"]
+    assert (first.calls, second.calls) == (1, 1)
+
+
+def test_changed_input_reruns_the_step(workspace):
+    folder, steps, first, second = workspace
+    make_runner(folder, steps).run()
+    (folder / "raw.txt").write_text("new raw data")
+    # first rewrites first.txt with a new call count, so second sees a changed input too
+    assert statuses(make_runner(folder, steps).run()) == ["succeeded", "succeeded"]
+
+
+def test_config_change_reruns_only_the_steps_reading_it(workspace):
+    folder, steps, first, second = workspace
+    make_runner(folder, steps).run()
+    (folder / "config.ini").write_text("[first]\nvalue = 1\n[second]\nvalue = 2\n")
+    assert statuses(make_runner(folder, steps).run()) == ["cached", "succeeded"]
+
+
+def test_missing_output_reruns_the_step(workspace):
+    folder, steps, first, second = workspace
+    make_runner(folder, steps).run()
+    (folder / "second.txt").unlink()
+    assert statuses(make_runner(folder, steps).run()) == ["cached", "succeeded"]
+
+
+def test_force_and_always_run_ignore_the_cache(workspace):
+    folder, steps, first, second = workspace
+    make_runner(folder, steps).run()
+    assert statuses(make_runner(folder, steps).run(force=True)) == ["succeeded", "succeeded"]
+    steps[0] = Step("first", steps[0].function, inputs=steps[0].inputs, outputs=steps[0].outputs,
+                    config=steps[0].config, always_run=True)
+    assert statuses(make_runner(folder, steps).run())[0] == "succeeded"
+
+
+def test_failed_step_is_recorded_and_resumed(workspace):
+    folder, steps, first, second = workspace
+    second.fail = True
+    with pytest.raises(RuntimeError):
+        make_runner(folder, steps).run()
+    runner = make_runner(folder, steps)
+    assert runner.failed_step() == "second"
+
+    second.fail = False
+    assert statuses(runner.run(start_at=runner.failed_step())) == ["not_run", "succeeded"]
+    assert first.calls == 1
+    state = json.loads((folder / "state" / "state.json").read_text())
+    assert state["failed_step"] is None and state["steps"]["second"]["status"] == "succeeded"
+
+
+def test_unknown_start_step_is_rejected(workspace):
+    folder, steps, first, second = workspace
+    with pytest.raises(ValueError):
+        make_runner(folder, steps).run(start_at="missing")
+
+
+def test_change_in_a_code_dependency_reruns_the_step(workspace):
+    folder, steps, first, second = workspace
+    module_path = folder / "helpers.py"
+    module_path.write_text("SCALE = 1\n")
+    spec = importlib.util.spec_from_file_location("helpers", module_path)
+    helpers = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(helpers)
+    steps[1] = Step("second", steps[1].function, inputs=steps[1].inputs, outputs=steps[1].outputs,
+                    config=steps[1].config, code=(helpers,))
+
+    make_runner(folder, steps).run()
+    module_path.write_text("SCALE = 2\n")
+    assert statuses(make_runner(folder, steps).run()) == ["cached", "succeeded"]